@@ -0,0 +1,78 @@
+"""Бенчмарк стоимости вставки сообщения при росте истории.
+
+Вставляет rows сообщений по одному (как обработчик чата с CHAT_BATCH_WINDOW_MS=0)
+во временную базу и печатает среднюю стоимость вставки по блокам. Очистка по
+MAX_CHAT_MESSAGES должна оставлять стоимость плоской: если последний блок дороже
+первого больше чем в max-ratio раз, скрипт завершается с кодом 1.
+
+    python bench_retention.py --rows 120000 --max-messages 50
+    python bench_retention.py --rows 200000 --max-messages 100000 --slack 1000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Логи бенчмарка не должны попадать в лог сервера
+os.environ.setdefault('LOG_FILEPATH', os.path.join(tempfile.gettempdir(), 'bench_retention.log'))
+
+from loguru import logger
+
+from config import MAX_CHAT_MESSAGES, MESSAGE_RETENTION_SLACK
+from database import Database
+
+
+def run(rows: int, max_messages: int, slack: int, block: int):
+    """Вставить rows сообщений, вернуть среднюю стоимость вставки по блокам в микросекундах"""
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(
+            db_path=os.path.join(directory, 'bench.db'),
+            max_messages=max_messages,
+            retention_slack=slack,
+            read_pool_size=1
+        )
+        db.init_tables()
+        db.add_user('bench-uuid', 'bench')
+
+        costs = []
+        started = time.perf_counter()
+        for n in range(1, rows + 1):
+            db.add_message('text', f'message {n}', 'bench-uuid')
+            if n % block == 0:
+                now = time.perf_counter()
+                costs.append((n, (now - started) / block * 1e6))
+                started = now
+
+        stored = db.conn.execute('SELECT COUNT(*) FROM Messages').fetchone()[0]
+        db.close()
+    return costs, stored
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Стоимость вставки сообщения при росте истории')
+    parser.add_argument('--rows', type=int, default=120_000, help='сколько сообщений вставить')
+    parser.add_argument('--max-messages', type=int, default=MAX_CHAT_MESSAGES, help='лимит MAX_CHAT_MESSAGES')
+    parser.add_argument('--slack', type=int, default=MESSAGE_RETENTION_SLACK, help='MESSAGE_RETENTION_SLACK')
+    parser.add_argument('--block', type=int, default=10_000, help='вставок в одном замере')
+    parser.add_argument('--max-ratio', type=float, default=2.0,
+                        help='допустимое отношение стоимости последнего блока к первому')
+    args = parser.parse_args()
+
+    logger.remove()
+    costs, stored = run(args.rows, args.max_messages, args.slack, max(1, args.block))
+    if not costs:
+        parser.error('--rows должно быть не меньше --block')
+
+    print(f'лимит {args.max_messages}, запас {args.slack}, вставок {args.rows}')
+    for inserted, cost in costs:
+        print(f'{inserted:>10} вставок: {cost:8.1f} мкс/вставка')
+    ratio = costs[-1][1] / costs[0][1]
+    print(f'строк в базе: {stored}, последний блок / первый: {ratio:.2f}')
+    if ratio > args.max_ratio:
+        print(f'Стоимость вставки растет с историей (> {args.max_ratio})')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
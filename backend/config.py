@@ -11,13 +11,74 @@ PROTOCOL = os.getenv('PROTOCOL', 'https').lower()
 HOST = os.getenv('HOST', '0.0.0.0')
 PORT = int(os.getenv('PORT', '8080'))
 MAX_CHAT_MESSAGES = int(os.getenv('MAX_CHAT_MESSAGES', '50'))
+RECENT_MESSAGES_BUFFER = int(os.getenv('RECENT_MESSAGES_BUFFER', str(MAX_CHAT_MESSAGES)))  # сообщений в памяти для /api/messages
+MESSAGES_PAGE_MAX_SIZE = int(os.getenv('MESSAGES_PAGE_MAX_SIZE', '100'))
+MESSAGE_RETENTION_SLACK = int(os.getenv('MESSAGE_RETENTION_SLACK', '10'))  # сколько сообщений сверх лимита копится до очистки
+DB_READ_WORKERS = int(os.getenv('DB_READ_WORKERS', '4'))
+CHAT_BATCH_WINDOW_MS = int(os.getenv('CHAT_BATCH_WINDOW_MS', '10'))  # 0 - коммит на каждое сообщение
+CHAT_BATCH_MAX_SIZE = int(os.getenv('CHAT_BATCH_MAX_SIZE', '100'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))  # секунды
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-16000'))  # отрицательное значение - размер в КиБ
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
 LOG_FORMAT = '{time} | {level} | {file} | {line} | {function} | {message} | {extra}'
 LOG_FILEPATH = os.getenv('LOG_FILEPATH', '/data/logs/backend_bungaacord.log')
 TURN_SECRET_KEY = os.getenv('TURN_SECRET_KEY')
+PRESENCE_TICK_MS = int(os.getenv('PRESENCE_TICK_MS', '100'))  # период пакетной рассылки статусов, 0 - без задержки
+PRESENCE_HISTORY_SIZE = int(os.getenv('PRESENCE_HISTORY_SIZE', '256'))  # пакетов статусов для догоняющей синхронизации
+WS_CODEC = os.getenv('WS_CODEC', 'json').lower()  # json | orjson - кодек WebSocket для клиентов без ?codec=; msgpack только по запросу
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # если задан, /metrics требует заголовок Authorization: Bearer <token>
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', '25'))  # секунд между ping одного соединения
+HEARTBEAT_SLOTS = int(os.getenv('HEARTBEAT_SLOTS', '25'))  # слотов колеса, ping рассылается по слотам в течение интервала
+HEARTBEAT_TIMEOUT = float(os.getenv('HEARTBEAT_TIMEOUT', '75'))  # секунд без входящих кадров до отключения
+RESUME_WINDOW = float(os.getenv('RESUME_WINDOW', '180'))  # секунд после отключения, в течение которых переподключение возвращает в комнату
+WS_MAX_HANDSHAKES = int(os.getenv('WS_MAX_HANDSHAKES', '32'))  # одновременных рукопожатий /ws, остальные ждут в очереди
+WS_HANDSHAKE_QUEUE = int(os.getenv('WS_HANDSHAKE_QUEUE', '512'))  # мест в очереди рукопожатий, сверх - 503
+WS_HANDSHAKE_WAIT = float(os.getenv('WS_HANDSHAKE_WAIT', '10'))  # секунд ожидания в очереди до 503
+RECONNECT_RATE = float(os.getenv('RECONNECT_RATE', '200'))  # переподключений в секунду на процесс, по которым размазываются подсказки
+RECONNECT_MIN_DELAY = float(os.getenv('RECONNECT_MIN_DELAY', '1'))  # минимальная задержка переподключения, секунды
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '5'))  # секунд на рассылку подсказок и закрытие соединений при остановке
+SEND_QUEUE_MAX_SIZE = int(os.getenv('SEND_QUEUE_MAX_SIZE', '256'))  # кадров в очереди отправки одного WebSocket
+SEND_QUEUE_OVERFLOW_POLICY = os.getenv('SEND_QUEUE_OVERFLOW_POLICY', 'drop_oldest').lower()  # drop_oldest | disconnect
+SEND_QUEUE_COALESCIBLE_TYPES = [
+    message_type.strip()
+    for message_type in os.getenv('SEND_QUEUE_COALESCIBLE_TYPES', 'ping').split(',')
+    if message_type.strip()
+]
+# Лимиты частоты сообщений одной WebSocket сессии: класс=токенов_в_секунду:запас, 0 токенов - без лимита
+WS_RATE_LIMITS = {
+    name.strip(): tuple(float(value) for value in spec.split(':', 1))
+    for name, _, spec in (
+        item.partition('=')
+        for item in os.getenv('WS_RATE_LIMITS', 'chat=5:10,presence=10:30,signal=50:200,screen=20:100').split(',')
+    )
+    if name.strip() and spec
+}
+UPLOAD_RATE_LIMIT = tuple(float(value) for value in os.getenv('UPLOAD_RATE_LIMIT', '0.2:5').split(':', 1))  # загрузок на пользователя
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 CERT_FILEPATH = os.path.join(CURRENT_DIR, 'cert.pem')
 KEY_FILEPATH = os.path.join(CURRENT_DIR, 'key.pem')
+MEDIA_DIR = os.path.join(CURRENT_DIR, 'static', 'media')
+AVATARS_DIR = os.path.join(CURRENT_DIR, 'static', 'avatars')
+MEDIA_GC_INTERVAL = float(os.getenv('MEDIA_GC_INTERVAL', '5'))  # секунды между проходами сборщика
+MEDIA_GC_BATCH_SIZE = int(os.getenv('MEDIA_GC_BATCH_SIZE', '100'))
+MEDIA_GC_MAX_RETRIES = int(os.getenv('MEDIA_GC_MAX_RETRIES', '5'))
+MEDIA_MAX_SIZE = int(os.getenv('MEDIA_MAX_SIZE', str(50 * 1024 * 1024)))  # байт, загрузка прерывается сразу при превышении
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', str(64 * 1024)))  # байт за одно чтение из запроса
+UPLOAD_WRITE_BUFFER = int(os.getenv('UPLOAD_WRITE_BUFFER', str(1024 * 1024)))  # байт, копящихся перед записью на диск в потоке
+AVATAR_MAX_SIZE = int(os.getenv('AVATAR_MAX_SIZE', str(10 * 1024 * 1024)))  # байт
+AVATAR_MAX_PIXELS = int(os.getenv('AVATAR_MAX_PIXELS', str(40 * 1000 * 1000)))  # пикселей, большие изображения не декодируются
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '1'))  # процессов обработки изображений
+IMAGE_QUEUE_SIZE = int(os.getenv('IMAGE_QUEUE_SIZE', '8'))  # изображений в обработке и очереди, сверх - 503
+IMAGE_WORKER_NICE = int(os.getenv('IMAGE_WORKER_NICE', '10'))  # понижение приоритета процессов обработки изображений
+WORKERS = int(os.getenv('WORKERS', '1'))  # больше 1 - несколько процессов на одном порту с общей шиной
+BACKPLANE = os.getenv('BACKPLANE', 'unix').lower()  # unix | redis
+BACKPLANE_SOCKET = os.getenv('BACKPLANE_SOCKET', os.path.join(CURRENT_DIR, 'db', 'backplane.sock'))
+BACKPLANE_REDIS_URL = os.getenv('BACKPLANE_REDIS_URL', 'redis://localhost:6379/0')
+BACKPLANE_CHANNEL = os.getenv('BACKPLANE_CHANNEL', 'bungaacord:backplane')
+BACKPLANE_HEARTBEAT = float(os.getenv('BACKPLANE_HEARTBEAT', '5'))  # секунды; воркер без сигналов 3 интервала считается упавшим
 
 logger.remove()
 logger.add(sys.stdout,
@@ -1,28 +1,280 @@
 # database.py
+import asyncio
+import queue
 import sqlite3
 import os
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import quote
 from datetime import datetime, timezone
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from loguru import logger
 
-from config import MAX_CHAT_MESSAGES, CURRENT_DIR
+from config import (
+    MAX_CHAT_MESSAGES,
+    MESSAGE_RETENTION_SLACK,
+    CURRENT_DIR,
+    AVATARS_DIR,
+    DB_READ_WORKERS,
+    CHAT_BATCH_WINDOW_MS,
+    CHAT_BATCH_MAX_SIZE,
+    SQLITE_SYNCHRONOUS,
+    SQLITE_CACHE_SIZE,
+    SQLITE_MMAP_SIZE,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+    RECENT_MESSAGES_BUFFER,
+    WORKERS
+)
+from media_gc import media_reclaimer
+from metrics import registry, db_query_seconds
+
+
+class UserCache:
+    """Ограниченный LRU-кеш строк Users с временем жизни записей"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Поколение растет при каждой инвалидации, чтобы чтение, начатое до записи,
+        # не положило в кеш устаревшую строку
+        self._generation = 0
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, uuid: str) -> Optional[Dict[str, Any]]:
+        """Получить пользователя из кеша или None"""
+        with self._lock:
+            item = self._items.get(uuid)
+            if item is not None:
+                expires_at, user = item
+                if expires_at > time.monotonic():
+                    self._items.move_to_end(uuid)
+                    self.hits += 1
+                    return dict(user)
+                del self._items[uuid]
+            self.misses += 1
+            return None
+
+    def put(self, uuid: str, user: Dict[str, Any], generation: int):
+        """Положить пользователя в кеш, если с начала чтения не было инвалидаций"""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._items[uuid] = (time.monotonic() + self.ttl, dict(user))
+            self._items.move_to_end(uuid)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, uuid: Optional[str] = None):
+        """Удалить пользователя из кеша (или очистить кеш целиком)"""
+        with self._lock:
+            self._generation += 1
+            if uuid is None:
+                self._items.clear()
+            else:
+                self._items.pop(uuid, None)
+
+    def stats(self) -> Dict[str, int]:
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+
+def _migration_users_avatar(cursor: sqlite3.Cursor):
+    """Столбец avatar в Users для баз, созданных до появления аватарок"""
+    cursor.execute('PRAGMA table_info(Users)')
+    if 'avatar' not in {row['name'] for row in cursor.fetchall()}:
+        cursor.execute('ALTER TABLE Users ADD COLUMN avatar TEXT DEFAULT NULL')
+
+
+def _migration_messages_indexes(cursor: sqlite3.Cursor):
+    """Индексы Messages по времени и автору"""
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_datetime ON Messages (datetime)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_uuid ON Messages (user_uuid)')
+
+
+def _migration_resume_sessions(cursor: sqlite3.Cursor):
+    """Таблица снимка комнат для автовосстановления после перезапуска"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ResumeSessions (
+            user_uuid TEXT PRIMARY KEY,
+            room TEXT NOT NULL,
+            username TEXT,
+            time REAL NOT NULL
+        )
+    ''')
+
+
+def _migration_media_refs(cursor: sqlite3.Cursor):
+    """Счетчики ссылок сообщений на медиа файлы"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS MediaRefs (
+            name TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("SELECT content FROM Messages WHERE type = 'media'")
+    refs = Counter(os.path.basename(row['content']) for row in cursor.fetchall())
+    cursor.executemany(
+        'INSERT OR REPLACE INTO MediaRefs (name, refs) VALUES (?, ?)',
+        list(refs.items())
+    )
+
+
+def _migration_drop_unused_message_indexes(cursor: sqlite3.Cursor):
+    """Удалить индексы Messages, которые не использует ни один запрос.
+
+    Выборки и очистка идут диапазоном по id, JOIN с Users - по первичному ключу,
+    поэтому индексы по datetime и user_uuid только удорожали каждую вставку.
+    """
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_datetime')
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_user_uuid')
+
+
+# Версионированные миграции схемы: (версия, описание, шаг). Шаги применяются по порядку
+# и должны быть идемпотентны. Новые шаги добавляются только в конец списка.
+MIGRATIONS = [
+    (1, 'Столбец avatar в Users', _migration_users_avatar),
+    (2, 'Индексы Messages по datetime и user_uuid', _migration_messages_indexes),
+    (3, 'Таблица ResumeSessions', _migration_resume_sessions),
+    (4, 'Таблица MediaRefs', _migration_media_refs),
+    (5, 'Удаление неиспользуемых индексов Messages', _migration_drop_unused_message_indexes),
+]
+
+# Запросы сообщений; те же строки проверяются через EXPLAIN QUERY PLAN
+MESSAGES_PAGE_SQL = (
+    'SELECT M.*, U.username FROM Messages M LEFT JOIN Users U ON M.user_uuid = U.uuid '
+    '{where} ORDER BY M.id {order} LIMIT ?'
+)
+RETENTION_DELETE_SQL = (
+    "DELETE FROM Messages WHERE id < ? "
+    "RETURNING CASE WHEN type = 'media' THEN content END AS media"
+)
+
+# Планы горячих запросов: (описание, запрос, параметры, обязательные фрагменты плана).
+# Сортировка во временном B-дереве и автоматический индекс считаются регрессией для любого запроса
+QUERY_PLAN_CHECKS = [
+    (
+        'последние сообщения',
+        MESSAGES_PAGE_SQL.format(where='', order='DESC'),
+        (1,),
+        ['SEARCH U USING INDEX'],
+    ),
+    (
+        'страница сообщений до курсора',
+        MESSAGES_PAGE_SQL.format(where='WHERE M.id < ?', order='DESC'),
+        (0, 1),
+        ['SEARCH M USING INTEGER PRIMARY KEY', 'SEARCH U USING INDEX'],
+    ),
+    (
+        'страница сообщений после курсора',
+        MESSAGES_PAGE_SQL.format(where='WHERE M.id > ?', order='ASC'),
+        (0, 1),
+        ['SEARCH M USING INTEGER PRIMARY KEY', 'SEARCH U USING INDEX'],
+    ),
+    (
+        'очистка старых сообщений',
+        RETENTION_DELETE_SQL,
+        (0,),
+        ['SEARCH Messages USING INTEGER PRIMARY KEY'],
+    ),
+    (
+        'пользователь по uuid',
+        'SELECT * FROM Users WHERE uuid = ?',
+        ('',),
+        ['SEARCH Users USING INDEX'],
+    ),
+]
 
 
 class Database:
-    def __init__(self, db_path: str = "app.db", max_messages=20):
+    def __init__(self, db_path: str = "app.db", max_messages=20, retention_slack: int = 10,
+                 read_pool_size: int = 4, synchronous: str = "NORMAL", cache_size: int = -16000,
+                 mmap_size: int = 0, user_cache_size: int = 1024, user_cache_ttl: float = 300,
+                 recent_buffer_size: int = 50, shared: bool = False):
         self.db_path = db_path
+        # Базу пишут несколько процессов: счетчики в памяти не считаются точными
+        self.shared = shared
         self.conn: Optional[sqlite3.Connection] = None
         self.MAX_MESSAGES = max_messages
+        self.retention_slack = max(retention_slack, 0)
+        self._message_count: Optional[int] = None
+        self.read_pool_size = read_pool_size
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.user_cache = UserCache(max_size=user_cache_size, ttl=user_cache_ttl)
+        # Версии данных растут после каждого изменения; по ним кешируются ответы API
+        self.messages_version = 0
+        self.rooms_version = 0
+        self.users_version = 0
+        # Кольцевой буфер последних сообщений (уже с username), от старых к новым
+        self._recent_messages: "deque[Dict[str, Any]]" = deque(maxlen=max(recent_buffer_size, 0))
+        self._recent_loaded = False
+        self._recent_lock = threading.Lock()
+        # Пул соединений только для чтения, отдельный от единственного соединения записи
+        self._read_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._read_conns: List[sqlite3.Connection] = []
 
     def connect(self):
         """Установить соединение с базой данных"""
         self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        # WAL позволяет читателям работать параллельно с записью
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        self._apply_cache_pragmas(self.conn)
+
+        for _ in range(self.read_pool_size):
+            conn = sqlite3.connect(
+                f'file:{quote(os.path.abspath(self.db_path))}?mode=ro',
+                uri=True,
+                check_same_thread=False
+            )
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA query_only=ON')
+            self._apply_cache_pragmas(conn)
+            self._read_conns.append(conn)
+            self._read_pool.put(conn)
+
+    def _apply_cache_pragmas(self, conn: sqlite3.Connection):
+        """Применить настройки кеша страниц и mmap к соединению"""
+        conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+
+    @contextmanager
+    def _read_connection(self):
+        """Взять соединение для чтения из пула на время запроса"""
+        if not self.conn:
+            self.connect()
+
+        conn = self._read_pool.get()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
 
     def close(self):
         """Закрыть соединение с базой данных"""
+        for conn in self._read_conns:
+            conn.close()
+        self._read_conns.clear()
+        self._read_pool = queue.Queue()
         if self.conn:
             self.conn.close()
+            self.conn = None
 
     def init_tables(self):
         """Инициализировать таблицы в базе данных"""
@@ -66,6 +318,58 @@ class Database:
         # Выполняем миграцию базы данных
         self.migrate_database()
 
+        self._load_recent_messages()
+
+    def _load_recent_messages(self):
+        """Заполнить буфер последних сообщений и счетчик сообщений из базы"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            MESSAGES_PAGE_SQL.format(where='', order='DESC'),
+            (self._recent_messages.maxlen,)
+        )
+        rows = [dict(row) for row in cursor.fetchall()]
+
+        cursor.execute('SELECT COUNT(*) as count FROM Messages')
+        self._message_count = cursor.fetchone()['count']
+
+        with self._recent_lock:
+            self._recent_messages.clear()
+            self._recent_messages.extend(reversed(rows))
+            self._recent_loaded = True
+
+    def _append_recent_messages(self, messages: List[Dict[str, Any]]):
+        """Добавить только что записанные сообщения в буфер"""
+        with self._recent_lock:
+            if not self._recent_loaded:
+                return
+            last_id = self._recent_messages[-1]['id'] if self._recent_messages else 0
+            self._recent_messages.extend(message for message in messages if message['id'] > last_id)
+
+    def _trim_recent_messages(self, keep_from_id: int):
+        """Убрать из буфера сообщения, удаленные очисткой"""
+        with self._recent_lock:
+            while self._recent_messages and self._recent_messages[0]['id'] < keep_from_id:
+                self._recent_messages.popleft()
+
+    def _set_recent_username(self, uuid: str, username: Optional[str]):
+        """Обновить username у сообщений пользователя в буфере"""
+        with self._recent_lock:
+            for message in self._recent_messages:
+                if message['user_uuid'] == uuid:
+                    message['username'] = username
+        self.messages_version += 1
+
+    def _get_username(self, uuid: Optional[str]) -> Optional[str]:
+        """Получить username для записи в буфер: из кеша пользователей или соединением записи"""
+        if uuid is None:
+            return None
+        user = self.user_cache.get(uuid)
+        if user is None:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT username FROM Users WHERE uuid = ?', (uuid,))
+            user = cursor.fetchone()
+        return user['username'] if user else None
+
     def add_admin_user(self, uuid: str, username: str):
         """Добавить администратора в таблицу Users"""
         if not self.conn:
@@ -84,6 +388,9 @@ class Database:
                 (uuid, username, True)
             )
             self.conn.commit()
+            self.user_cache.invalidate(uuid)
+            self.users_version += 1
+            self._set_recent_username(uuid, username)
             logger.info(f"Администратор {username} добавлен в базу данных")
         else:
             logger.info(f"Администратор {username} уже существует в базе данных")
@@ -106,135 +413,252 @@ class Database:
                 (uuid, username, is_admin)
             )
             self.conn.commit()
+            self.user_cache.invalidate(uuid)
+            self.users_version += 1
+            self._set_recent_username(uuid, username)
             logger.info(f"Пользователь {username} добавлен в базу данных")
             return True
         else:
             logger.info(f"Пользователь {username} уже существует в базе данных")
             return False
 
-    def add_message(self, message_type: str, content: str, user_uuid: Optional[str] = None) -> int:
-        """Добавить сообщение в таблицу Messages"""
+    def add_message(self, message_type: str, content: str, user_uuid: Optional[str] = None) -> Tuple[int, str]:
+        """Добавить сообщение в таблицу Messages, вернуть (id, datetime)"""
+        return self.add_messages([(message_type, content, user_uuid)])[0]
+
+    def add_messages(self, messages: List[Tuple[str, str, Optional[str]]]) -> List[Tuple[int, str]]:
+        """Добавить пачку сообщений одной транзакцией, вернуть (id, datetime) для каждого"""
         if not self.conn:
             self.connect()
 
         cursor = self.conn.cursor()
+        results = []
+        recent = []
 
-        # Добавляем новое сообщение
-        datetime_str = datetime.now(timezone.utc).isoformat()
-        cursor.execute(
-            'INSERT INTO Messages (type, content, datetime, user_uuid) VALUES (?, ?, ?, ?)',
-            (message_type, content, datetime_str, user_uuid)
-        )
+        try:
+            for message_type, content, user_uuid in messages:
+                datetime_str = datetime.now(timezone.utc).isoformat()
+                cursor.execute(
+                    'INSERT INTO Messages (type, content, datetime, user_uuid) VALUES (?, ?, ?, ?)',
+                    (message_type, content, datetime_str, user_uuid)
+                )
+                results.append((cursor.lastrowid, datetime_str))
+                if message_type == 'media':
+                    # Одинаковые файлы хранятся один раз, сообщения держат на них ссылки
+                    cursor.execute(
+                        'INSERT INTO MediaRefs (name, refs) VALUES (?, 1) '
+                        'ON CONFLICT(name) DO UPDATE SET refs = refs + 1',
+                        (os.path.basename(content),)
+                    )
+                recent.append({
+                    "id": cursor.lastrowid,
+                    "type": message_type,
+                    "content": content,
+                    "datetime": datetime_str,
+                    "user_uuid": user_uuid,
+                    "username": self._get_username(user_uuid)
+                })
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
 
-        message_id = cursor.lastrowid
-        self.conn.commit()
+        self._append_recent_messages(recent)
+        self.messages_version += 1
 
         # Проверяем лимит сообщений и удаляем старые при необходимости
-        self._enforce_message_limit(message_type)
+        self._enforce_message_limit(len(messages))
 
-        return message_id
+        return results
 
-    def _enforce_message_limit(self, message_type: str):
-        """Проверить и применить ограничение на количество сообщений"""
+    def _enforce_message_limit(self, added: int = 1):
+        """Применить ограничение на количество сообщений.
+
+        Счетчик сообщений хранится в памяти, а удаление запускается только когда
+        лимит превышен на retention_slack: все лишние строки удаляются одним
+        DELETE по диапазону первичного ключа, без COUNT и сортировки.
+        """
         if not self.conn:
             return
 
         cursor = self.conn.cursor()
 
-        # Получаем общее количество сообщений
-        cursor.execute('SELECT COUNT(*) as count FROM Messages')
-        count = cursor.fetchone()['count']
-
-        # Если превышен лимит, удаляем самые старые сообщения
-        if count > self.MAX_MESSAGES:
-            # Получаем ID самых старых сообщений, которые нужно удалить
-            cursor.execute('''
-                SELECT id, type, content FROM Messages 
-                ORDER BY datetime ASC 
-                LIMIT ?
-            ''', (count - self.MAX_MESSAGES,))
-
-            messages_to_delete = cursor.fetchall()
-
-            for message in messages_to_delete:
-                # Если это медиа-сообщение, удаляем файл
-                if message['type'] == 'media':
-                    file_path = message['content']
-                    self._delete_media_file(file_path)
+        if self.shared:
+            # Другие процессы тоже пишут и удаляют, поэтому число строк берем из диапазона id
+            cursor.execute('SELECT MIN(id) as min_id, MAX(id) as max_id FROM Messages')
+            row = cursor.fetchone()
+            self._message_count = row['max_id'] - row['min_id'] + 1 if row['min_id'] is not None else 0
+        elif self._message_count is None:
+            cursor.execute('SELECT COUNT(*) as count FROM Messages')
+            self._message_count = cursor.fetchone()['count']
+        else:
+            self._message_count += added
 
-                # Удаляем запись из базы данных
-                cursor.execute('DELETE FROM Messages WHERE id = ?', (message['id'],))
+        if self._message_count <= self.MAX_MESSAGES + self.retention_slack:
+            return
 
-            self.conn.commit()
-            logger.info(f"Удалено {len(messages_to_delete)} старых сообщений для соблюдения лимита")
+        # id монотонно растут, поэтому лишние сообщения - это префикс по id.
+        # Если в id есть пропуски, удалится меньше строк, а остаток догонит следующая очистка
+        cursor.execute('SELECT MIN(id) as min_id FROM Messages')
+        min_id = cursor.fetchone()['min_id']
+        if min_id is None:
+            self._message_count = 0
+            return
+        keep_from_id = min_id + self._message_count - self.MAX_MESSAGES
 
-    def _delete_media_file(self, file_path: str):
-        """Удалить медиа файл с диска"""
         try:
-            # Преобразуем относительный путь в абсолютный
-            if file_path.startswith('/static/media/'):
-                file_path = '.' + file_path
-            else:
-                # Добавляем путь к папке static/media
-                file_path = f'./static/media/{file_path}'
-
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                logger.info(f"Медиа файл удален: {file_path}")
-        except Exception as e:
-            logger.info(f"Ошибка при удалении медиа файла {file_path}: {e}")
+            # Ссылки считаем по строкам, удаленным именно этой транзакцией: другой
+            # воркер мог уже удалить часть префикса, и его ссылки вычитать нельзя
+            cursor.execute(RETENTION_DELETE_SQL, (keep_from_id,))
+            rows = cursor.fetchall()
+            deleted = len(rows)
+            media_refs = Counter(os.path.basename(row['media']) for row in rows if row['media'])
+
+            # Файл удаляется только вместе с последним ссылающимся сообщением
+            cursor.executemany(
+                'UPDATE MediaRefs SET refs = refs - ? WHERE name = ?',
+                [(count, name) for name, count in media_refs.items()]
+            )
+            cursor.execute('SELECT name FROM MediaRefs WHERE refs <= 0')
+            media_paths = [row['name'] for row in cursor.fetchall()]
+            cursor.execute('DELETE FROM MediaRefs WHERE refs <= 0')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+        self._message_count -= deleted
+        self._trim_recent_messages(keep_from_id)
+        self.messages_version += 1
+
+        # Файлы удаленных медиа-сообщений удалит фоновый сборщик
+        for file_path in media_paths:
+            media_reclaimer.enqueue(file_path)
+
+        logger.info(f"Удалено {deleted} старых сообщений для соблюдения лимита")
+
+    def apply_remote_change(self, kind: str, key: Optional[str] = None):
+        """Учесть изменение, сделанное другим процессом: сбросить кеши и поднять версии"""
+        if kind == 'messages':
+            self._message_count = None
+            self.messages_version += 1
+        elif kind == 'users':
+            if key:
+                self.user_cache.invalidate(key)
+            self.users_version += 1
+            self.messages_version += 1
+        elif kind == 'rooms':
+            self.rooms_version += 1
 
     def get_user_by_uuid(self, uuid: str) -> Optional[Dict[str, Any]]:
         """Получить пользователя по UUID"""
-        if not self.conn:
-            self.connect()
-
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM Users WHERE uuid = ?', (uuid,))
-        row = cursor.fetchone()
+        user = self.user_cache.get(uuid)
+        if user is not None:
+            return user
+        return self._fetch_user_by_uuid(uuid)
+
+    def _fetch_user_by_uuid(self, uuid: str) -> Optional[Dict[str, Any]]:
+        """Прочитать пользователя из базы и положить в кеш"""
+        generation = self.user_cache.generation
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM Users WHERE uuid = ?', (uuid,))
+            row = cursor.fetchone()
 
         if row:
-            return dict(row)
+            user = dict(row)
+            self.user_cache.put(uuid, user, generation)
+            return user
         return None
 
     def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
         """Получить пользователя по имени"""
-        if not self.conn:
-            self.connect()
-
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM Users WHERE username = ?', (username,))
-        row = cursor.fetchone()
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM Users WHERE username = ?', (username,))
+            row = cursor.fetchone()
 
-        if row:
-            return dict(row)
-        return None
+            if row:
+                return dict(row)
+            return None
 
     def get_recent_messages(self, limit: int = 20) -> List[Dict[str, Any]]:
         """Получить последние сообщения"""
-        if not self.conn:
-            self.connect()
+        return self.get_messages_page(limit)
+
+    def get_messages_page(self, limit: int = 20, before_id: Optional[int] = None,
+                          after_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Получить страницу сообщений (от новых к старым) по курсору before_id/after_id"""
+        messages = self._get_messages_page_from_buffer(limit, before_id, after_id)
+        if messages is not None:
+            return messages
+        return self._fetch_messages_page(limit, before_id, after_id)
+
+    def _get_messages_page_from_buffer(self, limit: int, before_id: Optional[int] = None,
+                                       after_id: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        """Получить страницу сообщений из буфера или None, если буфер ее не покрывает"""
+        if limit <= 0:
+            return []
+
+        with self._recent_lock:
+            if not self._recent_loaded:
+                return None
+
+            buffered = list(self._recent_messages)
+            # Неполный буфер содержит все сообщения из базы
+            holds_all = len(buffered) < self._recent_messages.maxlen
+
+            if after_id is not None:
+                if not holds_all and (not buffered or buffered[0]['id'] > after_id + 1):
+                    return None
+                messages = [message for message in buffered if message['id'] > after_id][:limit]
+            else:
+                if before_id is not None:
+                    buffered = [message for message in buffered if message['id'] < before_id]
+                if not holds_all and len(buffered) < limit:
+                    return None
+                messages = buffered[-limit:]
+
+            return [dict(message) for message in reversed(messages)]
+
+    def _fetch_messages_page(self, limit: int, before_id: Optional[int] = None,
+                             after_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Прочитать страницу сообщений из базы диапазоном по первичному ключу"""
+        if after_id is not None:
+            # Ближайшие limit сообщений после курсора
+            where, params, order = 'WHERE M.id > ?', (after_id,), 'ASC'
+        elif before_id is not None:
+            where, params, order = 'WHERE M.id < ?', (before_id,), 'DESC'
+        else:
+            where, params, order = '', (), 'DESC'
 
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT M.*, U.username 
-            FROM Messages M 
-            LEFT JOIN Users U ON M.user_uuid = U.uuid
-            ORDER BY M.datetime DESC 
-            LIMIT ?
-        ''', (limit,))
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(MESSAGES_PAGE_SQL.format(where=where, order=order), (*params, limit))
 
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+            rows = [dict(row) for row in cursor.fetchall()]
 
-    def get_message_count(self) -> int:
-        """Получить общее количество сообщений"""
-        if not self.conn:
-            self.connect()
+        if order == 'ASC':
+            rows.reverse()
+        return rows
 
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT COUNT(*) as count FROM Messages')
-        return cursor.fetchone()['count']
+    def get_message_count(self) -> int:
+        """Получить общее количество сообщений (из счетчика в памяти, если он уже загружен)"""
+        if self._message_count is not None:
+            return self._message_count
+
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COUNT(*) as count FROM Messages')
+            return cursor.fetchone()['count']
+
+    def get_all_users(self) -> List[Dict[str, Any]]:
+        """Получить список всех пользователей"""
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT uuid, username, is_admin FROM Users ORDER BY username')
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
 
     def delete_user(self, uuid: str) -> bool:
         """Удалить пользователя по UUID"""
@@ -253,6 +677,9 @@ class Database:
         # Удаляем пользователя
         cursor.execute('DELETE FROM Users WHERE uuid = ?', (uuid,))
         self.conn.commit()
+        self.user_cache.invalidate(uuid)
+        self.users_version += 1
+        self._set_recent_username(uuid, None)
 
         logger.info(f"Пользователь {user['username']} удален из базы данных")
         return True
@@ -267,6 +694,7 @@ class Database:
         try:
             cursor.execute('INSERT INTO VoiceRooms (name) VALUES (?)', (room_name,))
             self.conn.commit()
+            self.rooms_version += 1
             logger.info(f"Комната '{room_name}' добавлена в базу данных")
             return True
         except sqlite3.IntegrityError:
@@ -275,26 +703,22 @@ class Database:
 
     def get_voice_rooms(self) -> List[Dict[str, Any]]:
         """Получить список всех голосовых комнат"""
-        if not self.conn:
-            self.connect()
-
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id, name FROM VoiceRooms ORDER BY name')
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows]
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, name FROM VoiceRooms ORDER BY name')
+            rows = cursor.fetchall()
+            return [dict(row) for row in rows]
 
     def get_voice_room_by_name(self, room_name: str) -> Optional[Dict[str, Any]]:
         """Получить комнату по имени"""
-        if not self.conn:
-            self.connect()
+        with self._read_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, name FROM VoiceRooms WHERE name = ?', (room_name,))
+            row = cursor.fetchone()
 
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT id, name FROM VoiceRooms WHERE name = ?', (room_name,))
-        row = cursor.fetchone()
-
-        if row:
-            return dict(row)
-        return None
+            if row:
+                return dict(row)
+            return None
 
     def voice_room_exists(self, room_name: str) -> bool:
         """Проверить, существует ли комната"""
@@ -312,14 +736,83 @@ class Database:
         else:
             logger.info("Комната 'General' уже существует")
 
+    def is_media_referenced(self, name: str) -> bool:
+        """Есть ли сообщения, ссылающиеся на медиа файл"""
+        with self._read_connection() as conn:
+            row = conn.execute('SELECT refs FROM MediaRefs WHERE name = ?', (name,)).fetchone()
+            return row is not None and row['refs'] > 0
+
+    def save_resume_sessions(self, rows: List[Tuple[str, str, Optional[str], float]]):
+        """Заменить снимок комнат для автовосстановления"""
+        if not self.conn:
+            self.connect()
+
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM ResumeSessions')
+        cursor.executemany(
+            'INSERT INTO ResumeSessions (user_uuid, room, username, time) VALUES (?, ?, ?, ?)',
+            rows
+        )
+        self.conn.commit()
+        logger.info(f"Сохранено записей автовосстановления: {len(rows)}")
+
+    def load_resume_sessions(self) -> List[Dict[str, Any]]:
+        """Прочитать снимок комнат для автовосстановления"""
+        with self._read_connection() as conn:
+            cursor = conn.execute('SELECT user_uuid, room, username, time FROM ResumeSessions')
+            return [dict(row) for row in cursor.fetchall()]
+
     def migrate_database(self):
-        """Миграция базы данных для добавления столбца avatar"""
+        """Применить недостающие миграции схемы по порядку версий"""
         if not self.conn:
             self.connect()
 
-        # cursor = self.conn.cursor()
+        cursor = self.conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS SchemaVersion (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TEXT NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+        for version, description, migration in MIGRATIONS:
+            if version <= self.get_schema_version():
+                continue
+            try:
+                migration(cursor)
+                cursor.execute(
+                    'INSERT INTO SchemaVersion (version, description, applied_at) VALUES (?, ?, ?)',
+                    (version, description, datetime.now(timezone.utc).isoformat())
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                logger.exception(f"Ошибка миграции {version}: {description}")
+                raise
+            logger.info(f"Применена миграция {version}: {description}")
+
+        for problem in self.check_query_plans():
+            logger.warning(f"План запроса не использует индекс: {problem}")
+
+    def get_schema_version(self) -> int:
+        """Получить текущую версию схемы"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT MAX(version) as version FROM SchemaVersion')
+        return cursor.fetchone()['version'] or 0
 
-        pass
+    def check_query_plans(self) -> List[str]:
+        """Проверить через EXPLAIN QUERY PLAN, что горячие запросы идут по индексам"""
+        cursor = self.conn.cursor()
+        problems = []
+        for description, query, params, expected in QUERY_PLAN_CHECKS:
+            cursor.execute(f'EXPLAIN QUERY PLAN {query}', params)
+            plan = ' | '.join(row['detail'] for row in cursor.fetchall())
+            missing = [fragment for fragment in expected if fragment not in plan]
+            if missing or 'USE TEMP B-TREE' in plan or 'AUTOMATIC' in plan:
+                problems.append(f"{description}: {plan}")
+        return problems
 
     def update_user_avatar(self, uuid: str, avatar_path: str) -> bool:
         """Обновить аватарку пользователя"""
@@ -339,6 +832,8 @@ class Database:
             (avatar_path, uuid)
         )
         self.conn.commit()
+        self.user_cache.invalidate(uuid)
+        self.users_version += 1
 
         # Если у пользователя была старая аватарка, удаляем её
         if old_avatar_path and old_avatar_path != avatar_path:
@@ -347,5 +842,214 @@ class Database:
         logger.info(f"Аватарка пользователя обновлена: {avatar_path}")
         return True
 
+    def _delete_avatar_file(self, avatar_url: str):
+        """Удалить файл прежней аватарки по её URL"""
+        file_path = os.path.join(AVATARS_DIR, os.path.basename(avatar_url))
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.info(f"Ошибка при удалении аватарки {file_path}: {e}")
+
+
+class AsyncDatabase:
+    """Асинхронный фасад над Database.
+
+    Запросы выполняются в пулах потоков, чтобы дисковый I/O не блокировал event loop:
+    чтение идет параллельно в нескольких потоках, запись - последовательно в одном.
+    После успешной записи вызывается on_change(вид изменения, ключ), если он задан.
+    """
+
+    # Пишущий метод Database -> вид изменения для on_change
+    CHANGE_KINDS = {
+        'add_user': 'users',
+        'add_admin_user': 'users',
+        'delete_user': 'users',
+        'update_user_avatar': 'users',
+        'add_voice_room': 'rooms',
+        'add_message': 'messages',
+        'add_messages': 'messages',
+    }
+
+    def __init__(self, database: Database, read_workers: int = 4,
+                 batch_window_ms: int = 0, batch_max_size: int = 100):
+        self.db = database
+        self._reader = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-reader')
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        # Групповой коммит сообщений: вставки копятся в окне batch_window_ms и пишутся одной транзакцией
+        self.batch_window = batch_window_ms / 1000
+        self.batch_max_size = batch_max_size
+        self._pending_messages: List[Tuple[Tuple[str, str, Optional[str]], asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks = set()
+        self.on_change = None
+
+    async def _read(self, func, *args):
+        """Выполнить читающий запрос в пуле читателей"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._reader, func, *args)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - started, func.__name__)
+
+    async def _write(self, func, *args):
+        """Выполнить пишущий запрос в потоке записи"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            result = await loop.run_in_executor(self._writer, func, *args)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - started, func.__name__)
+
+        kind = self.CHANGE_KINDS.get(func.__name__)
+        if self.on_change is not None and kind is not None:
+            self.on_change(kind, args[0] if kind == 'users' else None)
+        return result
+
+    async def flush(self):
+        """Записать все накопленные сообщения, не дожидаясь окна батчинга"""
+        self._flush_messages()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+
+    def close(self):
+        """Дождаться завершения запросов и остановить пулы потоков"""
+        self._writer.shutdown(wait=True)
+        self._reader.shutdown(wait=True)
+
+    async def get_user_by_uuid(self, uuid: str) -> Optional[Dict[str, Any]]:
+        # Попадание в кеш отдаем сразу, без перехода в пул потоков
+        user = self.db.user_cache.get(uuid)
+        if user is not None:
+            return user
+        return await self._read(self.db._fetch_user_by_uuid, uuid)
+
+    async def get_user_by_username(self, username: str) -> Optional[Dict[str, Any]]:
+        return await self._read(self.db.get_user_by_username, username)
+
+    async def get_all_users(self) -> List[Dict[str, Any]]:
+        return await self._read(self.db.get_all_users)
+
+    async def get_recent_messages(self, limit: int = 20) -> List[Dict[str, Any]]:
+        return await self.get_messages_page(limit)
+
+    async def get_messages_page(self, limit: int = 20, before_id: Optional[int] = None,
+                                after_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        # Страницы из буфера последних сообщений отдаем без перехода в пул потоков
+        messages = self.db._get_messages_page_from_buffer(limit, before_id, after_id)
+        if messages is not None:
+            return messages
+        return await self._read(self.db._fetch_messages_page, limit, before_id, after_id)
+
+    async def get_message_count(self) -> int:
+        if self.db._message_count is not None:
+            return self.db._message_count
+        return await self._read(self.db.get_message_count)
+
+    async def get_voice_rooms(self) -> List[Dict[str, Any]]:
+        return await self._read(self.db.get_voice_rooms)
+
+    async def get_voice_room_by_name(self, room_name: str) -> Optional[Dict[str, Any]]:
+        return await self._read(self.db.get_voice_room_by_name, room_name)
+
+    async def voice_room_exists(self, room_name: str) -> bool:
+        return await self._read(self.db.voice_room_exists, room_name)
+
+    async def add_user(self, uuid: str, username: str, is_admin: bool = False) -> bool:
+        return await self._write(self.db.add_user, uuid, username, is_admin)
+
+    async def add_admin_user(self, uuid: str, username: str):
+        return await self._write(self.db.add_admin_user, uuid, username)
+
+    async def add_message(self, message_type: str, content: str, user_uuid: Optional[str] = None) -> Tuple[int, str]:
+        """Добавить сообщение, вернуть (id, datetime); при включенном батчинге - через групповой коммит"""
+        # Некорректная строка не должна попасть в общую транзакцию с чужими сообщениями
+        if not isinstance(message_type, str) or not isinstance(content, str):
+            raise ValueError("message_type и content должны быть строками")
+
+        if self.batch_window <= 0:
+            return await self._write(self.db.add_message, message_type, content, user_uuid)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_messages.append(((message_type, content, user_uuid), future))
+
+        if len(self._pending_messages) >= self.batch_max_size:
+            self._flush_messages()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush_messages)
+
+        return await future
+
+    def _flush_messages(self):
+        """Отправить накопленные сообщения на запись одной транзакцией"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending_messages = self._pending_messages, []
+        if not batch:
+            return
+
+        task = asyncio.ensure_future(self._commit_messages(batch))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _commit_messages(self, batch):
+        """Записать пачку сообщений и раздать каждому вызывающему его (id, datetime)"""
+        try:
+            results = await self._write(self.db.add_messages, [item for item, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0][1].done():
+                    batch[0][1].set_exception(e)
+                return
+            # Транзакция откатилась целиком: пишем по одному, чтобы ошибку получило только плохое сообщение
+            logger.warning(f"Ошибка групповой записи {len(batch)} сообщений, запись по одному: {e}")
+            for item in batch:
+                await self._commit_messages([item])
+            return
 
-db = Database(max_messages=MAX_CHAT_MESSAGES, db_path=os.path.join(CURRENT_DIR, "db", "app.db"))
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def delete_user(self, uuid: str) -> bool:
+        return await self._write(self.db.delete_user, uuid)
+
+    async def add_voice_room(self, room_name: str) -> bool:
+        return await self._write(self.db.add_voice_room, room_name)
+
+    async def update_user_avatar(self, uuid: str, avatar_path: str) -> bool:
+        return await self._write(self.db.update_user_avatar, uuid, avatar_path)
+
+
+db = Database(
+    max_messages=MAX_CHAT_MESSAGES,
+    retention_slack=MESSAGE_RETENTION_SLACK,
+    db_path=os.path.join(CURRENT_DIR, "db", "app.db"),
+    read_pool_size=DB_READ_WORKERS,
+    synchronous=SQLITE_SYNCHRONOUS,
+    cache_size=SQLITE_CACHE_SIZE,
+    mmap_size=SQLITE_MMAP_SIZE,
+    user_cache_size=USER_CACHE_SIZE,
+    user_cache_ttl=USER_CACHE_TTL,
+    # Буфер последних сообщений не видит записи других процессов, поэтому в кластере отключен
+    recent_buffer_size=RECENT_MESSAGES_BUFFER if WORKERS <= 1 else 0,
+    shared=WORKERS > 1
+)
+async_db = AsyncDatabase(
+    db,
+    read_workers=DB_READ_WORKERS,
+    batch_window_ms=CHAT_BATCH_WINDOW_MS,
+    batch_max_size=CHAT_BATCH_MAX_SIZE
+)
+# Сборщик не удаляет файл, если на него снова сослалось новое сообщение
+media_reclaimer.in_use = db.is_media_referenced
+
+registry.gauge_callback('user_cache_entries', 'Пользователей в кеше', lambda: db.user_cache.stats()["size"])
+registry.counter_callback('user_cache_hits_total', 'Попадания в кеш пользователей', lambda: db.user_cache.hits)
+registry.counter_callback('user_cache_misses_total', 'Промахи кеша пользователей', lambda: db.user_cache.misses)
+registry.gauge_callback('messages_stored', 'Сообщений в базе данных', lambda: db._message_count or 0)
@@ -1,5 +1,5 @@
 from aiohttp import web
-from database import db
+from database import async_db
 
 
 async def admin_handler(request):
@@ -10,14 +10,7 @@ async def admin_handler(request):
 async def get_all_users(request):
     """Получить список всех пользователей (только для админов)"""
     try:
-        if not db.conn:
-            db.connect()
-
-        cursor = db.conn.cursor()
-        cursor.execute('SELECT uuid, username, is_admin FROM Users ORDER BY username')
-        rows = cursor.fetchall()
-
-        users = [dict(row) for row in rows]
+        users = await async_db.get_all_users()
 
         return web.json_response({
             "status": "ok",
@@ -52,7 +45,7 @@ async def create_user(request):
             }, status=400)
 
         # Создаем пользователя
-        success = db.add_user(uuid, username, is_admin)
+        success = await async_db.add_user(uuid, username, is_admin)
 
         if success:
             return web.json_response({
@@ -99,7 +92,7 @@ async def delete_user(request):
             }, status=400)
 
         # Удаляем пользователя
-        success = db.delete_user(user_uuid)
+        success = await async_db.delete_user(user_uuid)
 
         if success:
             return web.json_response({
@@ -0,0 +1,64 @@
+import asyncio
+import math
+import random
+
+from config import (
+    WS_MAX_HANDSHAKES,
+    WS_HANDSHAKE_QUEUE,
+    WS_HANDSHAKE_WAIT,
+    RECONNECT_RATE,
+    RECONNECT_MIN_DELAY
+)
+
+
+def reconnect_delay(clients: int) -> float:
+    """Случайная задержка переподключения: clients подключений размазываются по окну с темпом RECONNECT_RATE"""
+    return RECONNECT_MIN_DELAY + random.uniform(0, max(1, clients) / RECONNECT_RATE)
+
+
+class AdmissionGate:
+    """Ограничение одновременных рукопожатий /ws.
+
+    Рукопожатие (пользователь из базы, снимок статусов, автовосстановление комнаты)
+    выполняют не больше max_active соединений; остальные ждут в очереди до
+    max_waiting мест не дольше wait секунд. Переполнение очереди, истекшее ожидание
+    и режим остановки сервера дают отказ, клиент переподключается позже.
+    """
+
+    def __init__(self, max_active: int = WS_MAX_HANDSHAKES, max_waiting: int = WS_HANDSHAKE_QUEUE,
+                 wait: float = WS_HANDSHAKE_WAIT):
+        self.max_active = max(1, max_active)
+        self.max_waiting = max_waiting
+        self.wait = wait
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.draining = False
+        self._semaphore = asyncio.Semaphore(self.max_active)
+
+    async def acquire(self) -> bool:
+        """Занять место для рукопожатия; False - подключение нужно отклонить"""
+        if self.draining or (self._semaphore.locked() and self.waiting >= self.max_waiting):
+            self.rejected += 1
+            return False
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.wait)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._semaphore.release()
+
+    def retry_after(self) -> int:
+        """Секунды для заголовка Retry-After с учетом очереди"""
+        return math.ceil(reconnect_delay(self.active + self.waiting))
@@ -1,26 +1,85 @@
+import asyncio
 import base64
-from datetime import datetime
 import hashlib
 import hmac
-import io
+import math
 import os
 import time
+from typing import Optional
 from aiohttp import web
-from config import TURN_SECRET_KEY
-from database import db
-from PIL import Image
+from config import TURN_SECRET_KEY, MESSAGES_PAGE_MAX_SIZE, MEDIA_DIR, MEDIA_MAX_SIZE, AVATARS_DIR, AVATAR_MAX_SIZE
+from database import db, async_db
+from handlers.rate_limit import upload_limiter
+from handlers.response_cache import response_cache
+from handlers.images import ImageQueueFull, ImageRejected, image_processor, process_avatar
+from handlers.uploads import UploadTooLarge, discard_upload, place_upload, read_upload, save_upload
+from metrics import upload_size_bytes, upload_duration_seconds, upload_deduplicated_bytes_total, rate_limited_total
+
+
+def _upload_rate_limited(user_uuid) -> Optional[web.Response]:
+    """Ответ 429, если пользователь превысил лимит загрузок"""
+    if upload_limiter.consume(user_uuid):
+        return None
+    rate_limited_total.inc('upload')
+    retry_after = math.ceil(upload_limiter.bucket(user_uuid).retry_after())
+    return web.json_response({
+        "status": "error",
+        "error": "Too many uploads, try again later"
+    }, status=429, headers={'Retry-After': str(retry_after)})
+
+
+def _file_too_large(limit: int) -> web.Response:
+    return web.json_response({
+        "status": "error",
+        "error": f"File too large (max {limit // (1024 * 1024)}MB)"
+    }, status=413)
+
+
+def _get_int_param(request, name: str) -> Optional[int]:
+    """Прочитать целочисленный query-параметр (None, если не передан)"""
+    value = request.query.get(name)
+    if value is None or value == '':
+        return None
+    return int(value)
 
 
 async def get_messages(request):
-    """Получить последние сообщения из базы данных"""
+    """Получить страницу сообщений из базы данных.
+
+    Пагинация по курсору: before_id - сообщения старше указанного id,
+    after_id - сообщения новее указанного id. Размер страницы ограничен MESSAGES_PAGE_MAX_SIZE.
+    """
     try:
-        limit = int(request.query.get('limit', 20))
-        messages = db.get_recent_messages(limit)
+        limit = _get_int_param(request, 'limit') or 20
+        limit = max(1, min(limit, MESSAGES_PAGE_MAX_SIZE))
+        before_id = _get_int_param(request, 'before_id')
+        after_id = _get_int_param(request, 'after_id')
+
+        include_total = request.query.get('include_total', '1') != '0'
+
+        async def build_payload():
+            messages = await async_db.get_messages_page(limit, before_id=before_id, after_id=after_id)
+            response = {
+                "status": "ok",
+                "messages": messages,
+                "has_more": len(messages) == limit,
+                "next_before_id": messages[-1]["id"] if messages else None
+            }
+            if include_total:
+                response["total"] = await async_db.get_message_count()
+            return response
+
+        return await response_cache.respond(
+            request,
+            ('messages', limit, before_id, after_id, include_total),
+            db.messages_version,
+            build_payload
+        )
+    except ValueError:
         return web.json_response({
-            "status": "ok",
-            "messages": messages,
-            "total": db.get_message_count()
-        })
+            "status": "error",
+            "error": "Invalid pagination parameters"
+        }, status=400)
     except Exception as e:
         return web.json_response({
             "status": "error",
@@ -32,15 +91,17 @@ async def get_current_user(request):
     """Получить информацию о текущем пользователе по UUID"""
     try:
         user_uuid = request.query.get('user', None)
-        user = db.get_user_by_uuid(user_uuid)
 
-        if not user:
-            return web.HTTPNotFound()
+        async def build_payload():
+            user = await async_db.get_user_by_uuid(user_uuid)
+            if not user:
+                return web.HTTPNotFound()
+            return {
+                "status": "ok",
+                "user": user
+            }
 
-        return web.json_response({
-            "status": "ok",
-            "user": user
-        })
+        return await response_cache.respond(request, ('user', user_uuid), db.users_version, build_payload)
     except Exception as e:
         return web.json_response({
             "status": "error",
@@ -51,11 +112,13 @@ async def get_current_user(request):
 async def get_voice_rooms(request):
     """Получить список всех голосовых комнат"""
     try:
-        rooms = db.get_voice_rooms()
-        return web.json_response({
-            "status": "ok",
-            "rooms": rooms
-        })
+        async def build_payload():
+            return {
+                "status": "ok",
+                "rooms": await async_db.get_voice_rooms()
+            }
+
+        return await response_cache.respond(request, ('rooms',), db.rooms_version, build_payload)
     except Exception as e:
         return web.json_response({
             "status": "error",
@@ -65,9 +128,15 @@ async def get_voice_rooms(request):
 
 async def upload_media(request):
     """Загрузка медиа файлов (изображений/видео)"""
+    started = time.perf_counter()
     try:
         user_uuid = request.query.get('user', None)
-        user = db.get_user_by_uuid(user_uuid)
+        if limited := _upload_rate_limited(user_uuid):
+            return limited
+        # Заведомо слишком большой запрос отклоняем до чтения тела (64 КиБ - запас на заголовки multipart)
+        if request.content_length is not None and request.content_length > MEDIA_MAX_SIZE + 64 * 1024:
+            return _file_too_large(MEDIA_MAX_SIZE)
+        user = await async_db.get_user_by_uuid(user_uuid)
         # Читаем multipart данные
         reader = await request.multipart()
         field = await reader.next()
@@ -97,34 +166,28 @@ async def upload_media(request):
                 "error": "Unsupported file type"
             }, status=400)
 
-        # Создаем уникальное имя файла
-        import uuid as uuid_lib
-        unique_id = uuid_lib.uuid4().hex
-        new_filename = f"{unique_id}_{filename}"
-        media_path = f"./static/media/{new_filename}"
-
-        # Сохраняем файл
-        size = 0
-        with open(media_path, 'wb') as f:
-            while True:
-                chunk = await field.read_chunk()
-                if not chunk:
-                    break
-                size += len(chunk)
-                f.write(chunk)
-
-        # Проверяем размер файла (макс 50MB)
-        if size > 50 * 1024 * 1024:
-            os.remove(media_path)
-            return web.json_response({
-                "status": "error",
-                "error": "File too large (max 50MB)"
-            }, status=400)
+        # Принимаем файл потоково, прерывая загрузку при превышении размера
+        try:
+            upload = await save_upload(field, MEDIA_DIR, MEDIA_MAX_SIZE)
+        except UploadTooLarge:
+            return _file_too_large(MEDIA_MAX_SIZE)
+        size = upload.size
 
-        # Сохраняем информацию о файле в БД
+        # Имя файла - хеш содержимого: повторная загрузка того же файла не занимает места
+        new_filename = f"{upload.sha256}.{file_ext}"
         media_type = 'image' if is_image else 'video'
         media_url = f"/static/media/{new_filename}"
-        message_id = db.add_message('media', media_url, user_uuid)
+
+        # Сохраняем информацию о файле в БД (вместе со ссылкой в MediaRefs), затем ставим файл на место
+        try:
+            message_id, message_datetime = await async_db.add_message('media', media_url, user_uuid)
+        except BaseException:
+            await asyncio.to_thread(discard_upload, upload.tmp_path)
+            raise
+        if not await asyncio.to_thread(place_upload, upload, os.path.join(MEDIA_DIR, new_filename)):
+            upload_deduplicated_bytes_total.inc('media', amount=size)
+        upload_size_bytes.observe(size, 'media')
+        upload_duration_seconds.observe(time.perf_counter() - started, 'media')
 
         return web.json_response({
             "status": "ok",
@@ -138,7 +201,7 @@ async def upload_media(request):
                 "size": size,
                 "user_uuid": user_uuid,
                 "username": user['username'],
-                "datetime": datetime.now().isoformat()
+                "datetime": message_datetime
             }
         })
 
@@ -151,8 +214,13 @@ async def upload_media(request):
 
 async def upload_avatar(request):
     """Загрузка аватарки пользователя"""
+    started = time.perf_counter()
     try:
         user_uuid = request.query.get('user', None)
+        if limited := _upload_rate_limited(user_uuid):
+            return limited
+        if request.content_length is not None and request.content_length > AVATAR_MAX_SIZE + 64 * 1024:
+            return _file_too_large(AVATAR_MAX_SIZE)
 
         # Читаем multipart данные
         reader = await request.multipart()
@@ -183,34 +251,33 @@ async def upload_avatar(request):
             }, status=400)
 
         new_filename = f"{user_uuid}_avatar.jpg"
-        avatar_path = f"./static/avatars/{new_filename}"
-
-        # Сохраняем файл
-        avatar_buffer = io.BytesIO()
-        while True:
-            chunk = await field.read_chunk()
-            if not chunk:
-                break
-            avatar_buffer.write(chunk)
-        avatar_buffer.seek(0)
-
-        # Проверяем размер файла (макс 10MB)
-        if avatar_buffer.getbuffer().nbytes > 10 * 1024 * 1024:
-            os.remove(avatar_path)
+        avatar_path = os.path.join(AVATARS_DIR, new_filename)
+
+        # Читаем файл, прерывая загрузку при превышении размера
+        try:
+            avatar_data = await read_upload(field, AVATAR_MAX_SIZE)
+        except UploadTooLarge:
+            return _file_too_large(AVATAR_MAX_SIZE)
+
+        # Декодирование и масштабирование - в пуле процессов, event loop не блокируется
+        try:
+            await image_processor.run(process_avatar, avatar_data, avatar_path)
+        except ImageQueueFull:
             return web.json_response({
                 "status": "error",
-                "error": "File too large (max 10MB)"
+                "error": "Image processing is busy, try again later"
+            }, status=503, headers={'Retry-After': '5'})
+        except ImageRejected as e:
+            return web.json_response({
+                "status": "error",
+                "error": str(e)
             }, status=400)
 
-        image = Image.open(avatar_buffer)
-        if file_ext == 'png':
-            image = image.convert('RGB')
-        image = image.resize((256, 256), Image.Resampling.LANCZOS)
-        image.save(avatar_path)
-
         # Обновляем аватарку пользователя в БД
         avatar_url = f"/static/avatars/{new_filename}"
-        db.update_user_avatar(user_uuid, avatar_url)
+        await async_db.update_user_avatar(user_uuid, avatar_url)
+        upload_size_bytes.observe(len(avatar_data), 'avatar')
+        upload_duration_seconds.observe(time.perf_counter() - started, 'avatar')
 
         return web.json_response({
             "status": "ok",
@@ -0,0 +1,238 @@
+import asyncio
+import os
+import struct
+import uuid
+
+from loguru import logger
+
+from handlers.codec import codecs, JsonCodec
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+# Кадр шины: 4 байта длины + JSON-список сообщений
+_HEADER = struct.Struct('!I')
+_codec = codecs.get('orjson', JsonCodec)
+# Сколько байт может скопиться в буфере отправки воркеру, прежде чем брокер его отключит
+BROKER_MAX_BUFFER = 64 * 1024 * 1024
+
+
+def _encode(messages) -> bytes:
+    return _codec.encode(messages).encode('utf-8')
+
+
+def _decode(payload):
+    return _codec.decode(payload)
+
+
+class Backplane:
+    """Шина сообщений между процессами-воркерами.
+
+    Базовая реализация для запуска в одном процессе ничего не рассылает. Сообщения -
+    словари с полем "kind"; шина добавляет к ним id воркера и не доставляет
+    воркеру его собственные сообщения.
+    """
+    clustered = False
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or uuid.uuid4().hex[:8]
+        self.published = 0
+        self.received = 0
+        self._on_message = None
+
+    async def start(self, on_message):
+        self._on_message = on_message
+
+    def publish(self, message):
+        pass
+
+    async def close(self):
+        pass
+
+    def _deliver(self, messages):
+        for message in messages:
+            if message.get("worker") == self.worker_id:
+                continue
+            self.received += 1
+            try:
+                self._on_message(message)
+            except Exception:
+                logger.exception(f"Ошибка обработки сообщения шины {message.get('kind')}")
+
+
+class _BatchingBackplane(Backplane):
+    """Шина, которая собирает сообщения одной итерации event loop в один кадр"""
+    clustered = True
+
+    def __init__(self, worker_id=None):
+        super().__init__(worker_id)
+        self._pending = []
+        self._scheduled = False
+
+    def publish(self, message):
+        self._pending.append({**message, "worker": self.worker_id})
+        self.published += 1
+        if not self._scheduled:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._send(_encode(batch))
+
+    def _send(self, payload: bytes):
+        raise NotImplementedError
+
+
+class UnixSocketBroker:
+    """Ретранслятор кадров между воркерами через unix-сокет; работает в главном процессе"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._server = None
+        self._clients = set()
+        self._tasks = set()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_client, self.path)
+        logger.info(f"Брокер шины слушает {self.path}")
+
+    async def _serve_client(self, reader, writer):
+        self._clients.add(writer)
+        self._tasks.add(asyncio.current_task())
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                payload = await reader.readexactly(_HEADER.unpack(header)[0])
+                for client in list(self._clients):
+                    if client is writer:
+                        continue
+                    if client.transport.get_write_buffer_size() > BROKER_MAX_BUFFER:
+                        logger.warning("Воркер не успевает читать шину, отключаем")
+                        self._clients.discard(client)
+                        client.close()
+                        continue
+                    client.write(header + payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(writer)
+            self._tasks.discard(asyncio.current_task())
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for client in list(self._clients):
+            client.close()
+        # Даем обработчикам клиентов завершиться до остановки event loop
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UnixSocketBackplane(_BatchingBackplane):
+    """Клиент брокера UnixSocketBroker"""
+
+    def __init__(self, path: str, worker_id=None):
+        super().__init__(worker_id)
+        self.path = path
+        self._writer = None
+        self._task = None
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._task = asyncio.create_task(self._read_loop(reader))
+
+    def _send(self, payload: bytes):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(_HEADER.pack(len(payload)) + payload)
+
+    async def _read_loop(self, reader):
+        try:
+            while True:
+                header = await reader.readexactly(_HEADER.size)
+                payload = await reader.readexactly(_HEADER.unpack(header)[0])
+                self._deliver(_decode(payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("Соединение с брокером шины потеряно")
+
+    async def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+        if self._task is not None:
+            self._task.cancel()
+
+
+class RedisBackplane(_BatchingBackplane):
+    """Шина через Redis Pub/Sub (подходит любой Redis-совместимый сервер)"""
+
+    def __init__(self, url: str, channel: str, worker_id=None):
+        super().__init__(worker_id)
+        if aioredis is None:
+            raise RuntimeError("Для BACKPLANE=redis нужен пакет redis")
+        self.url = url
+        self.channel = channel
+        self._redis = None
+        self._pubsub = None
+        self._outgoing = asyncio.Queue()
+        self._tasks = []
+
+    async def start(self, on_message):
+        await super().start(on_message)
+        self._redis = aioredis.from_url(self.url)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._tasks = [
+            asyncio.create_task(self._read_loop()),
+            asyncio.create_task(self._write_loop()),
+        ]
+
+    def _send(self, payload: bytes):
+        self._outgoing.put_nowait(payload)
+
+    async def _write_loop(self):
+        # Одна задача публикации сохраняет порядок кадров
+        while True:
+            payload = await self._outgoing.get()
+            try:
+                await self._redis.publish(self.channel, payload)
+            except Exception:
+                logger.exception("Ошибка публикации в шину Redis")
+
+    async def _read_loop(self):
+        async for item in self._pubsub.listen():
+            if item.get("type") == "message":
+                self._deliver(_decode(item["data"]))
+
+    async def close(self):
+        self._flush()
+        for _ in range(100):
+            if self._outgoing.empty():
+                break
+            await asyncio.sleep(0.01)
+        for task in self._tasks:
+            task.cancel()
+        if self._pubsub is not None:
+            await self._pubsub.close()
+        if self._redis is not None:
+            await self._redis.close()
+
+
+def create_backplane(kind: str, worker_id=None, socket_path=None, redis_url=None, channel=None) -> Backplane:
+    """Создать клиент шины по имени из конфигурации"""
+    if kind == 'redis':
+        return RedisBackplane(redis_url, channel, worker_id)
+    if kind == 'unix':
+        return UnixSocketBackplane(socket_path, worker_id)
+    raise ValueError(f"Неизвестный тип шины: {kind}")
@@ -0,0 +1,82 @@
+import json
+
+from loguru import logger
+
+from config import WS_CODEC
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """Стандартный JSON в текстовых кадрах"""
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def encode(message) -> str:
+        return json.dumps(message)
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+
+class OrjsonCodec:
+    """JSON через orjson: тот же формат кадров, быстрее кодирование и разбор"""
+    name = 'orjson'
+    binary = False
+
+    @staticmethod
+    def encode(message) -> str:
+        return orjson.dumps(message).decode('utf-8')
+
+    @staticmethod
+    def decode(data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack в бинарных кадрах; текстовые кадры клиента разбираются как JSON"""
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def encode(message) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        if isinstance(data, str):
+            return json.loads(data)
+        return msgpack.unpackb(data, raw=False)
+
+
+# Кодеки, доступные с установленными зависимостями
+codecs = {JsonCodec.name: JsonCodec}
+if orjson is not None:
+    codecs[OrjsonCodec.name] = OrjsonCodec
+if msgpack is not None:
+    codecs[MsgpackCodec.name] = MsgpackCodec
+
+# Клиенты без параметра codec (в том числе стандартный фронтенд) разбирают только
+# текстовые кадры JSON, поэтому по умолчанию допустим лишь текстовый кодек
+if WS_CODEC in codecs and not codecs[WS_CODEC].binary:
+    default_codec = codecs[WS_CODEC]
+else:
+    logger.warning(f"Кодек WebSocket '{WS_CODEC}' недоступен или бинарный, по умолчанию используется json")
+    default_codec = JsonCodec
+
+
+def negotiate_codec(requested):
+    """Выбрать кодек по запросу клиента; без запроса и для неизвестных значений - кодек по умолчанию"""
+    if requested in codecs:
+        return codecs[requested]
+    return default_codec
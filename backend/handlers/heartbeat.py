@@ -0,0 +1,125 @@
+import asyncio
+
+from loguru import logger
+
+from config import HEARTBEAT_INTERVAL, HEARTBEAT_SLOTS, HEARTBEAT_TIMEOUT
+
+
+class _HeartbeatState:
+    __slots__ = ("slot", "last_seen", "ping_id", "ping_sent", "rtt")
+
+    def __init__(self, slot, now):
+        self.slot = slot
+        self.last_seen = now
+        self.ping_id = None
+        self.ping_sent = None
+        self.rtt = None
+
+
+class HeartbeatWheel:
+    """Ping соединений, распределенных по слотам колеса.
+
+    За один тик обрабатывается один слот, поэтому за интервал каждое соединение
+    получает один ping, а нагрузка размазана по интервалу равномерно. Время приема
+    pong дает RTT клиента; соединение, от которого ничего не приходило дольше
+    timeout, передается в on_timeout.
+    """
+
+    def __init__(self, send_ping, on_timeout, interval: float = HEARTBEAT_INTERVAL,
+                 slots: int = HEARTBEAT_SLOTS, timeout: float = HEARTBEAT_TIMEOUT):
+        self.send_ping = send_ping  # (список соединений, сообщение) -> None
+        self.on_timeout = on_timeout  # async (ws) -> None
+        self.interval = interval
+        self.timeout = timeout
+        self.pings_sent = 0
+        self.timeouts = 0
+        self.rtt_samples = 0
+        self.rtt_total = 0.0
+        self.rtt_max = 0.0
+        self._slots = [set() for _ in range(max(1, slots))]
+        self._state = {}  # ws -> _HeartbeatState
+        self._cursor = 0
+        self._ping_id = 0
+
+    def __len__(self):
+        return len(self._state)
+
+    @staticmethod
+    def _now():
+        return asyncio.get_running_loop().time()
+
+    def add(self, ws):
+        """Поставить соединение в наименее загруженный слот"""
+        if ws in self._state:
+            return
+        slot = min(range(len(self._slots)), key=lambda index: len(self._slots[index]))
+        self._slots[slot].add(ws)
+        self._state[ws] = _HeartbeatState(slot, self._now())
+
+    def discard(self, ws):
+        state = self._state.pop(ws, None)
+        if state is not None:
+            self._slots[state.slot].discard(ws)
+
+    def touch(self, ws):
+        """Отметить, что от соединения пришел кадр"""
+        state = self._state.get(ws)
+        if state is not None:
+            state.last_seen = self._now()
+
+    def pong(self, ws, ping_id=None):
+        """Учесть pong, вернуть RTT в секундах или None, если ping не ожидался"""
+        state = self._state.get(ws)
+        if state is None:
+            return None
+        now = self._now()
+        state.last_seen = now
+        if state.ping_sent is None or (ping_id is not None and ping_id != state.ping_id):
+            return None
+
+        rtt = now - state.ping_sent
+        state.ping_sent = None
+        state.rtt = rtt
+        self.rtt_samples += 1
+        self.rtt_total += rtt
+        self.rtt_max = max(self.rtt_max, rtt)
+        return rtt
+
+    def rtt(self, ws):
+        """Последний измеренный RTT соединения в секундах"""
+        state = self._state.get(ws)
+        return state.rtt if state is not None else None
+
+    async def tick(self):
+        """Обработать очередной слот: отключить молчащие соединения и разослать ping"""
+        now = self._now()
+        slot = self._slots[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self._slots)
+
+        expired = [ws for ws in slot if ws.closed or now - self._state[ws].last_seen > self.timeout]
+        for ws in expired:
+            self.discard(ws)
+            self.timeouts += 1
+            await self.on_timeout(ws)
+
+        if not slot:
+            return
+        self._ping_id += 1
+        for ws in slot:
+            state = self._state[ws]
+            state.ping_id = self._ping_id
+            state.ping_sent = now
+        self.pings_sent += len(slot)
+        self.send_ping(list(slot), {"type": "ping", "id": self._ping_id})
+
+    async def run(self):
+        """Крутить колесо: один слот за interval / slots секунд"""
+        step = self.interval / len(self._slots)
+        next_tick = self._now()
+        while True:
+            next_tick += step
+            await asyncio.sleep(max(0.0, next_tick - self._now()))
+            try:
+                await self.tick()
+            except Exception:
+                logger.exception("Ошибка heartbeat")
@@ -0,0 +1,121 @@
+import asyncio
+import io
+import multiprocessing
+import os
+import time
+import uuid
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+from PIL import Image
+
+from config import AVATAR_MAX_PIXELS, IMAGE_WORKERS, IMAGE_QUEUE_SIZE, IMAGE_WORKER_NICE
+from metrics import registry, image_processing_seconds
+
+
+class ImageRejected(Exception):
+    """Изображение не может быть обработано: поврежден файл или слишком много пикселей"""
+
+
+class ImageQueueFull(Exception):
+    """Очередь обработки изображений заполнена"""
+
+
+def _init_worker(max_pixels: int, nice: int):
+    # Обработка изображений не должна отнимать процессор у сигнализации
+    if nice:
+        os.nice(nice)
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    # Превышение MAX_IMAGE_PIXELS - ошибка, а не предупреждение
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+
+def process_avatar(data: bytes, path: str, size: int = 256):
+    """Декодировать, уменьшить до size x size и сохранить аватарку в JPEG (в процессе пула)"""
+    too_large = f"Image too large (max {Image.MAX_IMAGE_PIXELS} pixels)"
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # Размеры известны из заголовка, пиксели еще не декодированы
+            if image.width * image.height > Image.MAX_IMAGE_PIXELS:
+                raise ImageRejected(too_large)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image = image.resize((size, size), Image.Resampling.LANCZOS)
+    except (Image.DecompressionBombError, Image.DecompressionBombWarning):
+        raise ImageRejected(too_large)
+    except (Image.UnidentifiedImageError, OSError, SyntaxError) as e:
+        raise ImageRejected(f"Invalid image: {e}")
+
+    # Файл заменяется атомарно: клиенты не получат наполовину записанную аватарку
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    try:
+        image.save(tmp_path, 'JPEG')
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class ImageProcessor:
+    """Ограниченный пул процессов для декодирования и масштабирования изображений.
+
+    Одновременно в обработке и очереди не больше max_pending заданий, остальные
+    сразу получают ImageQueueFull. Процессы запускаются через spawn при первом
+    задании, чтобы не наследовать потоки сервера.
+    """
+
+    def __init__(self, workers: int = IMAGE_WORKERS, max_pending: int = IMAGE_QUEUE_SIZE,
+                 max_pixels: int = AVATAR_MAX_PIXELS, nice: int = IMAGE_WORKER_NICE):
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.max_pixels = max_pixels
+        self.nice = nice
+        self.pending = 0
+        self.rejected = 0
+        self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(self.max_pixels, self.nice)
+            )
+        return self._executor
+
+    async def run(self, func, *args, kind: str = 'avatar'):
+        """Выполнить func(*args) в пуле процессов"""
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise ImageQueueFull()
+
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        except BrokenProcessPool:
+            # Процесс пула упал (например, по памяти) - следующее задание создаст пул заново
+            logger.warning("Пул обработки изображений сломан, будет пересоздан")
+            self._executor = None
+            raise
+        finally:
+            self.pending -= 1
+            image_processing_seconds.observe(time.perf_counter() - started, kind)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            logger.info("Пул обработки изображений остановлен")
+
+
+image_processor = ImageProcessor()
+
+registry.gauge_callback('image_queue_depth', 'Изображения в обработке и очереди пула процессов',
+                        lambda: image_processor.pending)
+registry.counter_callback('image_rejected_total', 'Изображения, отклоненные из-за заполненной очереди',
+                          lambda: image_processor.rejected)
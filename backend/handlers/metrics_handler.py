@@ -0,0 +1,25 @@
+import hmac
+
+from aiohttp import web
+
+from config import METRICS_TOKEN
+from metrics import registry
+
+
+async def metrics_handler(request):
+    """Метрики сервера в текстовом формате Prometheus"""
+    if METRICS_TOKEN:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+            return web.json_response({
+                "status": "error",
+                "error": "Unauthorized"
+            }, status=401)
+
+    return web.Response(
+        body=registry.render().encode('utf-8'),
+        headers={
+            'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+            'Cache-Control': 'no-cache'
+        }
+    )
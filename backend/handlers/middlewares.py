@@ -1,5 +1,5 @@
 from aiohttp import web
-from database import db
+from database import async_db
 
 
 @web.middleware
@@ -7,7 +7,7 @@ async def is_admin_middleware(request, handler):
     user_uuid = request.query.get('user', None)
     if not user_uuid:
         return web.HTTPNotFound()
-    user = db.get_user_by_uuid(user_uuid)
+    user = await async_db.get_user_by_uuid(user_uuid)
     if not user or not user.get('is_admin'):
         return web.HTTPNotFound()
 
@@ -19,7 +19,7 @@ async def is_user_middleware(request, handler):
     user_uuid = request.query.get('user', None)
     if not user_uuid:
         return web.HTTPNotFound()
-    user = db.get_user_by_uuid(user_uuid)
+    user = await async_db.get_user_by_uuid(user_uuid)
     if not user:
         return web.HTTPNotFound()
 
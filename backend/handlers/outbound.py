@@ -0,0 +1,120 @@
+import asyncio
+import time
+from collections import deque
+
+from aiohttp import WSCloseCode
+from loguru import logger
+
+from config import SEND_QUEUE_MAX_SIZE, SEND_QUEUE_OVERFLOW_POLICY, SEND_QUEUE_COALESCIBLE_TYPES
+from metrics import registry, ws_send_seconds
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DISCONNECT = 'disconnect'
+
+outbound_stats = {"dropped_frames": 0, "slow_consumer_disconnects": 0, "max_queue_depth": 0}
+
+
+class OutboundQueue:
+    """Ограниченная очередь исходящих кадров одного WebSocket.
+
+    Кадры пишет отдельная задача-писатель, поэтому медленный клиент не задерживает
+    рассылку остальным. При переполнении очереди либо выбрасывается самый старый кадр
+    заменяемого типа (ping, статусы), либо клиент отключается.
+    """
+
+    def __init__(self, ws, max_size: int = SEND_QUEUE_MAX_SIZE,
+                 overflow_policy: str = SEND_QUEUE_OVERFLOW_POLICY,
+                 coalescible_types=SEND_QUEUE_COALESCIBLE_TYPES):
+        self.ws = ws
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.coalescible_types = frozenset(coalescible_types)
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self._frames = deque()  # (frame, message_type, время постановки в очередь)
+        self._ready = asyncio.Event()
+        self._task = None
+        self._close_task = None
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        """Запустить задачу-писатель"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._writer())
+
+    def put(self, frame, message_type=None) -> bool:
+        """Поставить готовый кадр (str или bytes) в очередь, вернуть False, если он не принят"""
+        if self.closed or self.ws.closed:
+            return False
+
+        if len(self._frames) >= self.max_size and not self._drop_oldest_coalescible():
+            self._disconnect_slow_consumer()
+            return False
+
+        self._frames.append((frame, message_type, time.perf_counter()))
+        outbound_stats["max_queue_depth"] = max(outbound_stats["max_queue_depth"], len(self._frames))
+        self._ready.set()
+        return True
+
+    def _drop_oldest_coalescible(self) -> bool:
+        """Выбросить самый старый кадр заменяемого типа, если это разрешено политикой"""
+        if self.overflow_policy != OVERFLOW_DROP_OLDEST:
+            return False
+        for index, (_, message_type, _) in enumerate(self._frames):
+            if message_type in self.coalescible_types:
+                del self._frames[index]
+                self.dropped += 1
+                outbound_stats["dropped_frames"] += 1
+                return True
+        return False
+
+    def _disconnect_slow_consumer(self):
+        """Отключить клиента, который не успевает читать кадры"""
+        if self.closed:
+            return
+        logger.info(f"Очередь отправки переполнена ({len(self._frames)} кадров), клиент отключается")
+        outbound_stats["slow_consumer_disconnects"] += 1
+        self.dropped += len(self._frames)
+        outbound_stats["dropped_frames"] += len(self._frames)
+        self.close()
+        self._close_task = asyncio.create_task(
+            self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b'Slow consumer')
+        )
+
+    async def _writer(self):
+        """Писать кадры из очереди в сокет по одному"""
+        while True:
+            while not self._frames:
+                self._ready.clear()
+                await self._ready.wait()
+
+            frame, _, queued_at = self._frames.popleft()
+            try:
+                if isinstance(frame, bytes):
+                    await self.ws.send_bytes(frame)
+                else:
+                    await self.ws.send_str(frame)
+                self.sent += 1
+                ws_send_seconds.observe(time.perf_counter() - queued_at)
+            except Exception as e:
+                logger.info(f"Ошибка отправки сообщения: {e}")
+                self.close()
+                return
+
+    def close(self):
+        """Остановить писателя и отбросить неотправленные кадры"""
+        self.closed = True
+        self._frames.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+
+registry.counter_callback('ws_dropped_frames_total', 'Кадры, выброшенные из очередей отправки',
+                          lambda: outbound_stats["dropped_frames"])
+registry.counter_callback('ws_slow_consumer_disconnects_total', 'Отключения клиентов с переполненной очередью',
+                          lambda: outbound_stats["slow_consumer_disconnects"])
+registry.gauge_callback('ws_max_queue_depth', 'Максимальная глубина очереди отправки с момента запуска',
+                        lambda: outbound_stats["max_queue_depth"])
@@ -0,0 +1,113 @@
+import asyncio
+import uuid
+from collections import deque
+
+from config import PRESENCE_TICK_MS, PRESENCE_HISTORY_SIZE
+
+
+class PresenceAggregator:
+    """Сбор изменений статусов пользователей и пакетная рассылка раз в тик.
+
+    Изменения одного пользователя в одной комнате схлопываются до последнего состояния,
+    поэтому объем рассылки статусов ограничен частотой тиков, а не частотой событий.
+    Вход и выход в пределах одного тика взаимно уничтожаются: клиенты не знали
+    о входе и не должны получать выход из комнаты, где пользователя не видели.
+    Если после входа кто-то получил снимок (он уже содержит вход), выход рассылается.
+
+    Каждый пакет получает номер версии. Последние пакеты хранятся в истории, чтобы
+    клиент после пропуска кадра или переподключения мог получить только недостающие
+    изменения; иначе он получает снимок, который кодируется один раз на состояние.
+    Эпоха меняется при перезапуске сервера, версии разных эпох несравнимы.
+    """
+
+    def __init__(self, flush_callback, tick_ms: int = PRESENCE_TICK_MS,
+                 history_size: int = PRESENCE_HISTORY_SIZE):
+        self.flush_callback = flush_callback
+        self.tick = tick_ms / 1000
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self.published = 0
+        self.flushed = 0
+        self._pending = {}  # (room, username) -> update
+        self._pending_since = {}  # (room, username) -> published первого неразосланного изменения
+        self._snapshot_served = 0  # published на момент последней выдачи снимка
+        self._present = set()  # (room, username) в комнатах по разосланным пакетам
+        self._flush_handle = None
+        self._history = deque(maxlen=history_size)  # разосланные пакеты по возрастанию версии
+        self._snapshot = (None, {})  # (published на момент кодирования, имя кодека -> кадр)
+
+    def publish(self, update):
+        """Добавить изменение статуса; комната с префиксом "!" означает выход из нее"""
+        key = (update["room"].lstrip("!"), update["username"])
+        # Переставляем ключ в конец, чтобы сохранить порядок последних изменений
+        pending = self._pending.pop(key, None)
+        self.published += 1
+        if (
+            update["room"].startswith("!")
+            and pending is not None
+            and key not in self._present
+            and self._pending_since[key] > self._snapshot_served
+        ):
+            # Выход после еще не разосланного входа, который не попал ни в один снимок
+            del self._pending_since[key]
+            return
+        self._pending[key] = update
+        self._pending_since.setdefault(key, self.published)
+
+        if self.tick <= 0:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.tick, self.flush)
+
+    def flush(self):
+        """Разослать накопленные изменения одним кадром"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if not self._pending:
+            return
+        updates = list(self._pending.values())
+        for key, update in self._pending.items():
+            if update["room"].startswith("!"):
+                self._present.discard(key)
+            else:
+                self._present.add(key)
+        self._pending.clear()
+        self._pending_since.clear()
+        self.flushed += 1
+        self.version += 1
+
+        message = {
+            "type": "user_status_batch",
+            "epoch": self.epoch,
+            "version": self.version,
+            "updates": updates,
+        }
+        self._history.append(message)
+        self.flush_callback(message)
+
+    def snapshot_frame(self, state, codec):
+        """Получить закодированный снимок статусов; кодируется заново только после изменений"""
+        if self._snapshot[0] != self.published:
+            self._snapshot = (self.published, {})
+        self._snapshot_served = self.published
+        frames = self._snapshot[1]
+        if codec.name not in frames:
+            frames[codec.name] = codec.encode({
+                "type": "user_status_total",
+                "epoch": self.epoch,
+                "version": self.version,
+                "data": state,
+            })
+        return frames[codec.name]
+
+    def deltas_since(self, epoch, version):
+        """Получить пакеты новее version или None, если нужен полный снимок"""
+        if epoch != self.epoch or version is None or version > self.version:
+            return None
+        if version == self.version:
+            return []
+        if not self._history or self._history[0]["version"] > version + 1:
+            return None
+        return [message for message in self._history if message["version"] > version]
@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+from config import WS_RATE_LIMITS, UPLOAD_RATE_LIMIT
+
+
+class TokenBucket:
+    """Ведро токенов: пополняется со скоростью rate в секунду, вмещает не больше burst"""
+    __slots__ = ("rate", "burst", "tokens", "updated", "dropped")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.dropped = 0  # отклонено подряд с последнего успешного consume
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount: float = 1.0) -> bool:
+        """Взять токены, вернуть False, если их не хватает"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            self.dropped = 0
+            return True
+        self.dropped += 1
+        return False
+
+    def retry_after(self, amount: float = 1.0) -> float:
+        """Через сколько секунд хватит токенов"""
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+def session_buckets(limits=WS_RATE_LIMITS):
+    """Ведра токенов новой WebSocket сессии по классам сообщений"""
+    return {
+        message_class: TokenBucket(rate, burst)
+        for message_class, (rate, burst) in limits.items()
+        if rate > 0
+    }
+
+
+class KeyedRateLimiter:
+    """Ведра токенов с общими параметрами по ключу (например, user_uuid).
+
+    Число ведер ограничено max_keys: при переполнении удаляются полные ведра
+    (ключи, которые давно не обращались), затем самые старые.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+
+    def bucket(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                self._prune()
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def consume(self, key) -> bool:
+        if self.rate <= 0:
+            return True
+        return self.bucket(key).consume()
+
+    def _prune(self):
+        for key in [key for key, bucket in self._buckets.items() if bucket.full]:
+            del self._buckets[key]
+        while len(self._buckets) >= self.max_keys:
+            self._buckets.popitem(last=False)
+
+
+upload_limiter = KeyedRateLimiter(*UPLOAD_RATE_LIMIT)
@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import json
+from collections import OrderedDict
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Ответы меньше этого размера не сжимаем: выигрыш меньше накладных расходов
+MIN_COMPRESS_SIZE = 512
+
+# Суффиксы ETag сжатых вариантов: сильный валидатор у каждой кодировки свой
+ETAG_SUFFIXES = {None: '', 'gzip': '-gz', 'br': '-br'}
+
+
+class CachedBody:
+    """Сериализованный ответ одной версии данных и его сжатые варианты"""
+
+    def __init__(self, version, body: bytes):
+        self.version = version
+        self.body = body
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.etags = {f'"{self.digest}{suffix}"' for suffix in ETAG_SUFFIXES.values()}
+        self.encoded = {}
+
+    def etag(self, encoding=None) -> str:
+        """ETag варианта тела в кодировке encoding (None - без сжатия)"""
+        return f'"{self.digest}{ETAG_SUFFIXES[encoding]}"'
+
+    def encode(self, encoding: str) -> bytes:
+        """Получить тело в нужной кодировке, сжимая его только один раз"""
+        if encoding not in self.encoded:
+            if encoding == 'br':
+                self.encoded[encoding] = brotli.compress(self.body)
+            else:
+                self.encoded[encoding] = gzip.compress(self.body, compresslevel=6)
+        return self.encoded[encoding]
+
+
+class ResponseCache:
+    """Кеш JSON-ответов для часто опрашиваемых API.
+
+    Тело ответа сериализуется один раз на версию данных, клиент получает сильный ETag
+    и 304 на If-None-Match, а gzip/brotli варианты сжимаются один раз и переиспользуются.
+    У каждого варианта свой ETag, и любой из них подтверждает актуальность версии.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[tuple, CachedBody]" = OrderedDict()
+
+    async def respond(self, request, key: tuple, version, build_payload) -> web.Response:
+        """Ответить из кеша или построить payload через build_payload() для новой версии"""
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            payload = await build_payload()
+            if isinstance(payload, web.StreamResponse):
+                return payload
+            entry = CachedBody(version, json.dumps(payload).encode('utf-8'))
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        encoding = self._negotiate_encoding(request, entry)
+        headers = {
+            'ETag': entry.etag(encoding),
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        }
+
+        if_none_match = request.headers.get('If-None-Match', '')
+        if entry.etags.intersection(tag.strip() for tag in if_none_match.split(',')):
+            return web.Response(status=304, headers=headers)
+
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            body = entry.encode(encoding)
+        else:
+            body = entry.body
+
+        return web.Response(body=body, content_type='application/json', headers=headers)
+
+    @staticmethod
+    def _negotiate_encoding(request, entry: CachedBody):
+        """Выбрать кодировку сжатия по Accept-Encoding клиента"""
+        if len(entry.body) < MIN_COMPRESS_SIZE:
+            return None
+        accepted = set()
+        for part in request.headers.get('Accept-Encoding', '').lower().split(','):
+            name, _, params = part.partition(';')
+            if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(name.strip())
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+
+response_cache = ResponseCache()
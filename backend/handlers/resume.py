@@ -0,0 +1,127 @@
+import asyncio
+import heapq
+import time
+
+from config import RESUME_WINDOW
+
+
+class ResumeStore:
+    """Последние комнаты пользователей для автовосстановления при переподключении.
+
+    Пока пользователь в комнате, запись хранится без срока (time = None); окно
+    в window секунд отсчитывается с отключения. Истекшие записи
+    удаляет таймер, взведенный на ближайший срок, поэтому память ограничена числом
+    пользователей, бывших в комнатах за последнее окно. Время - unix timestamp,
+    чтобы записи переживали перезапуск и совпадали между воркерами.
+    """
+
+    def __init__(self, window: float = RESUME_WINDOW):
+        self.window = window
+        self.expired = 0
+        self._entries = {}  # user_uuid -> {"room", "username", "time"}
+        self._deadlines = []  # куча (срок, user_uuid); устаревшие элементы пропускаются
+        self._timer = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _deadline(self, entry):
+        """Срок записи; None - пользователь еще в комнате, запись не истекает"""
+        if entry.get("time") is None:
+            return None
+        return entry["time"] + self.window
+
+    def get(self, user_uuid):
+        """Запись пользователя, если окно восстановления еще не истекло"""
+        entry = self._entries.get(user_uuid)
+        if entry is None:
+            return None
+        deadline = self._deadline(entry)
+        if deadline is not None and deadline <= time.time():
+            return None
+        return entry
+
+    def put(self, user_uuid, entry):
+        """Сохранить запись; срок отсчитывается от entry["time"], без time запись бессрочна"""
+        deadline = self._deadline(entry)
+        if deadline is not None and deadline <= time.time():
+            self.discard(user_uuid)
+            return
+        self._entries[user_uuid] = entry
+        if deadline is None:
+            return
+        heapq.heappush(self._deadlines, (deadline, user_uuid))
+        self._compact()
+        self._schedule()
+
+    def discard(self, user_uuid):
+        self._entries.pop(user_uuid, None)
+
+    def expire(self):
+        """Удалить записи с истекшим сроком"""
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, user_uuid = heapq.heappop(self._deadlines)
+            entry = self._entries.get(user_uuid)
+            current = entry and self._deadline(entry)
+            if current is not None and current <= now:
+                del self._entries[user_uuid]
+                self.expired += 1
+        self._compact()
+
+    def _compact(self):
+        # Обновления оставляют в куче устаревшие сроки; перестраиваем, когда их много
+        if len(self._deadlines) > 2 * len(self._entries) + 64:
+            self._deadlines = [
+                (self._deadline(entry), user_uuid)
+                for user_uuid, entry in self._entries.items()
+                if entry.get("time") is not None
+            ]
+            heapq.heapify(self._deadlines)
+
+    def _on_timer(self):
+        self._timer = None
+        self.expire()
+        self._schedule()
+
+    def _schedule(self):
+        if not self._deadlines:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # без event loop (восстановление при старте) срок проверяет get
+        when = loop.time() + max(0.0, self._deadlines[0][0] - time.time())
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            self._timer.cancel()
+        self._timer = loop.call_at(when, self._on_timer)
+
+    def snapshot(self):
+        """Живые записи для сохранения: список (user_uuid, room, username, time).
+
+        Пользователи, еще находящиеся в комнатах, сохраняются с текущим временем:
+        окно восстановления для них начинается с остановки сервера.
+        """
+        self.expire()
+        now = time.time()
+        return [
+            (user_uuid, entry["room"], entry.get("username"), now if entry.get("time") is None else entry["time"])
+            for user_uuid, entry in self._entries.items()
+        ]
+
+    def restore(self, rows):
+        """Загрузить записи из снимка, пропуская истекшие; вернуть число загруженных.
+
+        Такие записи помечаются restored: их комнаты после перезапуска еще пусты.
+        """
+        before = len(self._entries)
+        for row in rows:
+            self.put(row["user_uuid"], {
+                "room": row["room"],
+                "username": row["username"],
+                "time": row["time"],
+                "restored": True,
+            })
+        return len(self._entries) - before
@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+import time
+import uuid
+from typing import NamedTuple
+
+from loguru import logger
+
+from config import UPLOAD_CHUNK_SIZE, UPLOAD_WRITE_BUFFER
+from media_gc import media_reclaimer
+from metrics import upload_throughput_bytes_per_second
+
+
+class UploadTooLarge(Exception):
+    """Загружаемый файл больше допустимого размера"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"File too large (max {limit // (1024 * 1024)}MB)")
+        self.limit = limit
+
+
+class StoredUpload(NamedTuple):
+    """Принятый файл во временном пути и его sha256"""
+    tmp_path: str
+    size: int
+    sha256: str
+
+
+def _write_block(file, hasher, data):
+    hasher.update(data)
+    file.write(data)
+
+
+def _discard(file, path):
+    file.close()
+    discard_upload(path)
+
+
+def discard_upload(tmp_path: str):
+    """Удалить временный файл загрузки"""
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+async def save_upload(field, directory: str, max_size: int, kind: str = 'media') -> StoredUpload:
+    """Потоково принять поле multipart во временный файл в directory.
+
+    Блоки по UPLOAD_WRITE_BUFFER хешируются и пишутся на диск в пуле потоков:
+    пока один блок пишется, следующий читается из сети. Превышение max_size
+    прерывает загрузку сразу (UploadTooLarge), временный файл при ошибке удаляется.
+    """
+    started = time.perf_counter()
+    tmp_path = os.path.join(directory, f".{uuid.uuid4().hex}.part")
+    file = await asyncio.to_thread(open, tmp_path, 'wb')
+    hasher = hashlib.sha256()
+    size = 0
+    buffer = bytearray()
+    pending = None
+    try:
+        while True:
+            chunk = await field.read_chunk(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise UploadTooLarge(max_size)
+            buffer += chunk
+            if len(buffer) >= UPLOAD_WRITE_BUFFER:
+                if pending is not None:
+                    await pending
+                data, buffer = buffer, bytearray()
+                pending = asyncio.ensure_future(asyncio.to_thread(_write_block, file, hasher, data))
+
+        if pending is not None:
+            await pending
+            pending = None
+        if buffer:
+            await asyncio.to_thread(_write_block, file, hasher, buffer)
+        await asyncio.to_thread(file.close)
+    except BaseException:
+        if pending is not None:
+            await asyncio.gather(pending, return_exceptions=True)
+        await asyncio.to_thread(_discard, file, tmp_path)
+        raise
+
+    elapsed = time.perf_counter() - started
+    throughput = size / elapsed if elapsed > 0 else 0.0
+    upload_throughput_bytes_per_second.observe(throughput, kind)
+    logger.info(f"Принят файл {size} байт за {elapsed:.2f} с ({throughput / 1024 ** 2:.1f} МБ/с)")
+    return StoredUpload(tmp_path, size, hasher.hexdigest())
+
+
+async def read_upload(field, max_size: int) -> bytes:
+    """Прочитать поле multipart в память, прерывая чтение при превышении max_size"""
+    data = bytearray()
+    while True:
+        chunk = await field.read_chunk(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        if len(data) + len(chunk) > max_size:
+            raise UploadTooLarge(max_size)
+        data += chunk
+    return bytes(data)
+
+
+def place_upload(upload: StoredUpload, path: str) -> bool:
+    """Поставить принятый файл по адресу его содержимого; False - такой файл уже был.
+
+    Вызывается после записи ссылки в MediaRefs. Под блокировкой сборщика (общей
+    для всех воркеров) файл не может быть удален между проверкой и заменой: либо
+    сборщик уже увидел ссылку, либо файл удален раньше и будет создан заново.
+    """
+    with media_reclaimer.file_lock:
+        if os.path.exists(path):
+            discard_upload(upload.tmp_path)
+            return False
+        os.replace(upload.tmp_path, path)
+        return True
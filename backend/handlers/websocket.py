@@ -1,17 +1,38 @@
 import asyncio
+import time
 
 from loguru import logger
-from datetime import datetime, timezone, timedelta
-from aiohttp import web, WSMsgType
-import json
-
-from database import db
+from datetime import datetime, timezone
+from aiohttp import web, WSMsgType, WSCloseCode
+
+from config import BACKPLANE_HEARTBEAT, DRAIN_TIMEOUT
+from database import db, async_db
+from handlers.admission import AdmissionGate, reconnect_delay
+from handlers.backplane import Backplane
+from handlers.codec import negotiate_codec
+from handlers.heartbeat import HeartbeatWheel
+from handlers.outbound import OutboundQueue
+from handlers.presence import PresenceAggregator
+from handlers.rate_limit import session_buckets
+from handlers.resume import ResumeStore
+from metrics import (
+    registry,
+    ws_messages_total,
+    ws_fanout_recipients,
+    ws_target_misses_total,
+    ws_rtt_seconds,
+    rate_limited_total
+)
 
 # Хранилище комнат и подключений
 rooms = {}  # room_name -> set of WebSocket connections
-connections = {}  # ws -> {"room": room_name, "username": username, "user_uuid": user_uuid}
+connections = {}  # ws -> {"room": room_name, "username": username, "user_uuid": user_uuid, "codec": codec, ...}
+user_sessions = {}  # user_uuid -> set of WebSocket connections (вкладки/устройства пользователя)
+fanout_stats = {"events": 0, "recipients": 0, "max_recipients": 0, "encode_seconds": 0.0}
+message_handlers = {}  # message_type -> (async handler(ws, session, data), класс лимита частоты)
 rooms_user_statuses = {}
-user_last_room = {}  # user_uuid -> {"room": room_name, "username": username, "time": timestamp} - для восстановления при переподключении
+remote_presence = {}  # (room, username) -> id воркера, которому принадлежит сессия
+user_last_room = ResumeStore()  # user_uuid -> {"room": room_name, "username": username, "time": timestamp отключения или None} - для восстановления при переподключении
 # {"room": {
 #   "username": {
 #       "user_uuid": user_uuid,
@@ -21,16 +42,54 @@ user_last_room = {}  # user_uuid -> {"room": room_name, "username": username, "t
 #   }
 
 
-def get_timestamp_ago(minutes=3):
-    return (datetime.now(timezone.utc) - timedelta(minutes=minutes)).timestamp()
-
-
-async def websocket_handler(request):
-    """Обработчик WebSocket соединений для сигнализации"""
+def message_handler(message_type, rate_class=None):
+    """Зарегистрировать обработчик входящего сообщения типа message_type.
+
+    rate_class - класс ведра токенов сессии (chat, presence, signal, screen), None - без лимита.
+    """
+    def decorator(handler):
+        message_handlers[message_type] = (handler, rate_class)
+        return handler
+    return decorator
+
+
+def register_session(ws, user_uuid, username, codec):
+    """Зарегистрировать соединение в connections и индексе user_uuid -> сессии"""
+    outbox = OutboundQueue(ws)
+    outbox.start()
+    connections[ws] = {
+        "room": None,
+        "status_room": None,  # комната, к которой относятся присланные клиентом статусы
+        "username": username,
+        "user_uuid": user_uuid,
+        "codec": codec,
+        "outbox": outbox,
+        "limits": session_buckets(),
+    }
+    user_sessions.setdefault(user_uuid, set()).add(ws)
+    heartbeat.add(ws)
+
+
+def unregister_session(ws):
+    """Удалить соединение из connections и индекса сессий, вернуть его info"""
+    heartbeat.discard(ws)
+    info = connections.pop(ws, None)
+    if info is not None:
+        info["outbox"].close()
+        sessions = user_sessions.get(info["user_uuid"])
+        if sessions is not None:
+            sessions.discard(ws)
+            if not sessions:
+                del user_sessions[info["user_uuid"]]
+    return info
+
+
+async def _accept_connection(request):
+    """Рукопожатие /ws: сессия, снимок статусов и автовосстановление комнаты"""
     user_uuid = request.query.get("user", None)
-    user = db.get_user_by_uuid(user_uuid)
+    user = await async_db.get_user_by_uuid(user_uuid)
     username = user["username"]
-    room_name = None
+    codec = negotiate_codec(request.query.get("codec"))
 
     ws = web.WebSocketResponse()
     await ws.prepare(request)
@@ -38,26 +97,33 @@ async def websocket_handler(request):
     # Проверяем, был ли пользователь в комнате до разрыва соединения
     previous_room_data = user_last_room.get(user_uuid)
 
-    connections[ws] = {"room": None, "username": username, "user_uuid": user_uuid}
+    register_session(ws, user_uuid, username, codec)
     logger.info(f"✓ Новое WebSocket соединение добавлено в чат: {username}")
 
-    # Отправляем текущие данные по юзерам в комнатах
-    await ws.send_json({"type": "user_status_total", "data": rooms_user_statuses})
-
-    # Если пользователь был в комнате не раньше 3 минут, автоматически возвращаем его
-    if previous_room_data and previous_room_data.get('time', 0) > get_timestamp_ago(minutes=3):
-        room_name = previous_room_data["room"]
-        if room_name in rooms:
+    # Отправляем изменения статусов с версии клиента или полный снимок
+    sync_presence(ws, request.query.get("presence_epoch"), request.query.get("presence_version"))
+
+    # Если окно восстановления не истекло, автоматически возвращаем пользователя в комнату.
+    # Запись без time - пользователь еще в комнате с другой вкладки или устройства,
+    # новая сессия в нее не входит
+    if previous_room_data and previous_room_data.get("time") is not None:
+        room_name = connections[ws]["status_room"] = previous_room_data["room"]
+        # После перезапуска комнаты пусты: записи из снимка возвращают в любую существующую комнату
+        if room_is_active(room_name) or (
+            previous_room_data.get("restored") and await async_db.voice_room_exists(room_name)
+        ):
             logger.info(
                 f"🔄 Автовосстановление: пользователь {username} возвращается в комнату {room_name}"
             )
 
             # Добавляем в комнату
-            rooms[room_name].add(ws)
+            rooms.setdefault(room_name, set()).add(ws)
             connections[ws]["room"] = room_name
+            # Пользователь снова в комнате: запись бессрочна до следующего отключения
+            remember_last_room(user_uuid, {"room": room_name, "username": username, "time": None})
 
             # Отправляем подтверждение присоединения
-            await ws.send_json({"type": "joined", "room": room_name})
+            send_message(ws, {"type": "joined", "room": room_name})
 
             # Уведомляем других участников о возвращении пользователя
             await broadcast_to_room(
@@ -67,15 +133,7 @@ async def websocket_handler(request):
             )
 
             # Отправляем пользователю список уже подключенных
-            peers_in_room = [
-                {
-                    "username": connections[conn]["username"],
-                    "user_uuid": connections[conn].get("user_uuid", ""),
-                }
-                for conn in rooms[room_name]
-                if conn != ws
-            ]
-            await ws.send_json({"type": "peers", "peers": peers_in_room})
+            send_message(ws, {"type": "peers", "peers": room_peers(room_name, ws)})
 
             # Обновляем статус пользователя
             rooms_user_statuses.setdefault(room_name, {})[username] = {
@@ -85,9 +143,8 @@ async def websocket_handler(request):
                 "is_streaming": False,
             }
 
-            await broadcast_to_server(
+            publish_presence(
                 {
-                    "type": "user_status_update",
                     "room": room_name,
                     "user_uuid": user_uuid,
                     "username": username,
@@ -97,418 +154,790 @@ async def websocket_handler(request):
                 }
             )
 
-    try:
-        async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
-                data = json.loads(msg.data)
-                message_type = data.get("type")
-
-                if message_type == "pong":
-                    continue
+    return ws, codec
 
-                logger.info(f"Пришло сообщение типа {message_type}")
 
-                if message_type == "join":
-                    # Пользователь присоединяется к комнате (голосовой чат)
-                    room_name = data.get("room")
-                    if not room_name:
-                        continue
-
-                    # Проверяем, существует ли комната в базе данных
-                    if not db.voice_room_exists(room_name):
-                        await ws.send_json(
-                            {
-                                "type": "error",
-                                "message": f"Комната '{room_name}' не существует",
-                            }
-                        )
-                        logger.info(
-                            f"Пользователь {username} пытался присоединиться к несуществующей комнате '{room_name}'"
-                        )
-                        continue
-
-                    # Обновляем информацию о комнате
-                    connections[ws]["room"] = room_name
-                    logger.info(
-                        f"✓ Пользователь {username} присоединился к комнате {room_name}"
-                    )
+async def websocket_handler(request):
+    """Обработчик WebSocket соединений для сигнализации"""
+    # При массовом переподключении рукопожатия идут ограниченными порциями
+    if not await admission.acquire():
+        return web.json_response(
+            {"status": "error", "error": "Сервер перегружен, повторите подключение позже"},
+            status=503,
+            headers={"Retry-After": str(admission.retry_after())},
+        )
+    try:
+        ws, codec = await _accept_connection(request)
+    finally:
+        admission.release()
 
-                    # Добавляем в комнату
-                    if room_name not in rooms:
-                        rooms[room_name] = set()
-                    rooms[room_name].add(ws)
-
-                    # Сохраняем состояние комнаты для автовосстановления
-                    user_last_room[user_uuid] = {
-                        "room": room_name,
-                        "username": username,
-                        "time": datetime.now(timezone.utc).timestamp()
-                    }
-
-                    rooms_user_statuses.setdefault(room_name, {})[username] = {
-                        "user_uuid": user_uuid,
-                        "is_mic_muted": False,
-                        "is_deafened": False,
-                        "is_streaming": False,
-                    }
-                    # Отправляем подтверждение присоединения
-                    await ws.send_json({"type": "joined", "room": room_name})
-
-                    # Уведомляем других участников о новом пользователе
-                    await broadcast_to_room(
-                        room_name,
+    try:
+        async for msg in ws:
+            if msg.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
+                continue
+            heartbeat.touch(ws)
+            data = codec.decode(msg.data)
+            message_type = data.get("type")
+
+            entry = message_handlers.get(message_type)
+            ws_messages_total.inc(message_type if entry is not None else "unknown")
+            if entry is None:
+                logger.info(f"Unrecognized message_type {message_type}")
+                continue
+            handler, rate_class = entry
+            session = connections.get(ws)
+            if session is None:
+                break
+
+            bucket = session["limits"].get(rate_class)
+            if bucket is not None and not bucket.consume():
+                rate_limited_total.inc(rate_class)
+                # О начале ограничения сообщаем один раз, чтобы не отвечать на флуд флудом
+                if bucket.dropped == 1:
+                    logger.info(f"Превышен лимит сообщений {rate_class}: {session['username']}")
+                    send_message(
+                        ws,
                         {
-                            "type": "peer_joined",
-                            "username": username,
-                            "user_uuid": user_uuid,
+                            "type": "error",
+                            "code": "rate_limited",
+                            "class": rate_class,
+                            "retry_after": round(bucket.retry_after(), 3),
+                            "message": "Слишком много сообщений, часть из них отброшена",
                         },
-                        exclude_ws=ws,
                     )
+                continue
 
-                    # Отправляем новому участнику список уже подключенных
-                    peers_in_room = [
-                        {
-                            "username": connections[conn]["username"],
-                            "user_uuid": connections[conn].get("user_uuid", ""),
-                        }
-                        for conn in rooms[room_name]
-                        if conn != ws
-                    ]
-                    await ws.send_json({"type": "peers", "peers": peers_in_room})
-
-                    await broadcast_to_server(
-                        {
-                            "type": "user_status_update",
-                            "room": room_name,
-                            "user_uuid": user_uuid,
-                            "username": username,
-                            "is_mic_muted": False,
-                            "is_deafened": False,
-                            "is_streaming": False,
-                        }
-                    )
+            if message_type != "pong":
+                logger.info(f"Пришло сообщение типа {message_type}")
+            await handler(ws, session, data)
 
-                elif message_type == "signal":
-                    # Пересылка сигнального сообщения конкретному пиру
-                    target_peer = data.get("target")
-                    signal_data = data.get("data")
-
-                    await send_to_target(
-                        target_uuid=target_peer,
-                        message={
-                            "type": "signal",
-                            "sender": user_uuid,
-                            "data": signal_data,
-                        },
-                    )
+    except Exception:
+        logger.exception("WebSocket error")
+    finally:
+        await _cleanup_connection(ws)
+    return ws
 
-                elif message_type == "user_status_update":
-                    # Обновление статуса пользователя (микрофон/звук)
-                    current_room = data.get("room", False)
-                    is_mic_muted = data.get("is_mic_muted", False)
-                    is_deafened = data.get("is_deafened", False)
-                    is_streaming = data.get("is_streaming", False)
-                    if current_room != room_name:
-                        rooms_user_statuses.get(room_name, dict()).pop(username)
-                        room_name = current_room
-                    if room_name and rooms_user_statuses.get(room_name, dict()).get(
-                        username
-                    ):
-                        rooms_user_statuses[room_name][username].update(
-                            {
-                                "is_mic_muted": is_mic_muted,
-                                "is_deafened": is_deafened,
-                                "is_streaming": is_streaming,
-                            }
-                        )
-
-                        # Рассылаем статус всем участникам комнаты
-                        await broadcast_to_server(
-                            {
-                                "type": "user_status_update",
-                                "room": room_name,
-                                "user_uuid": user_uuid,
-                                "username": username,
-                                "is_mic_muted": is_mic_muted,
-                                "is_deafened": is_deafened,
-                                "is_streaming": is_streaming,
-                            }
-                        )
-
-                elif message_type == "screen_share_request":
-                    target_peer = data.get("target")
-                    logger.info("screen_share_request")
-
-                    await send_to_target(
-                        target_uuid=target_peer,
-                        message={
-                            "type": "screen_share_request",
-                            "user_uuid": user_uuid,
-                        },
-                    )
 
-                elif message_type == "screen_share_stop_request":
-                    target_peer = data.get("target")
-                    logger.info("screen_share_stop_request")
+@message_handler("pong")
+async def handle_pong(ws, session, data):
+    """Ответ на ping: измеряем RTT клиента"""
+    rtt = heartbeat.pong(ws, data.get("id"))
+    if rtt is not None:
+        session["rtt"] = rtt
+        ws_rtt_seconds.observe(rtt)
 
-                elif message_type == "screen_share_stop":
-                    # Пользователь остановил демонстрацию экрана
 
-                    # Уведомляем всех участников комнаты
-                    await broadcast_to_server(
-                        {
-                            "type": "screen_share_stop",
-                            "peer_uuid": user_uuid,
-                            "username": username,
-                        },
-                        exclude_ws=ws,
-                    )
+@message_handler("join", rate_class="presence")
+async def handle_join(ws, session, data):
+    """Пользователь присоединяется к комнате (голосовой чат)"""
+    user_uuid = session["user_uuid"]
+    username = session["username"]
+    room_name = session["status_room"] = data.get("room")
+    if not room_name:
+        return
 
-                elif message_type == "screen_signal":
-                    # Пересылка сигнального сообщения для демонстрации экрана
-                    target_peer = data.get("target")
-                    signal_data = data.get("data")
-
-                    await send_to_target(
-                        target_uuid=target_peer,
-                        message={
-                            "type": "screen_signal",
-                            "sender": user_uuid,
-                            "data": signal_data,
-                        },
-                    )
+    # Проверяем, существует ли комната в базе данных
+    if not await async_db.voice_room_exists(room_name):
+        send_message(
+            ws,
+            {
+                "type": "error",
+                "message": f"Комната '{room_name}' не существует",
+            },
+        )
+        logger.info(
+            f"Пользователь {username} пытался присоединиться к несуществующей комнате '{room_name}'"
+        )
+        return
+
+    # Обновляем информацию о комнате
+    session["room"] = room_name
+    logger.info(
+        f"✓ Пользователь {username} присоединился к комнате {room_name}"
+    )
+
+    # Добавляем в комнату
+    if room_name not in rooms:
+        rooms[room_name] = set()
+    rooms[room_name].add(ws)
+
+    # Сохраняем состояние комнаты для автовосстановления; окно начнется с отключения
+    remember_last_room(user_uuid, {
+        "room": room_name,
+        "username": username,
+        "time": None
+    })
+
+    rooms_user_statuses.setdefault(room_name, {})[username] = {
+        "user_uuid": user_uuid,
+        "is_mic_muted": False,
+        "is_deafened": False,
+        "is_streaming": False,
+    }
+    # Отправляем подтверждение присоединения
+    send_message(ws, {"type": "joined", "room": room_name})
+
+    # Уведомляем других участников о новом пользователе
+    await broadcast_to_room(
+        room_name,
+        {
+            "type": "peer_joined",
+            "username": username,
+            "user_uuid": user_uuid,
+        },
+        exclude_ws=ws,
+    )
+
+    # Отправляем новому участнику список уже подключенных
+    send_message(ws, {"type": "peers", "peers": room_peers(room_name, ws)})
+
+    publish_presence(
+        {
+            "room": room_name,
+            "user_uuid": user_uuid,
+            "username": username,
+            "is_mic_muted": False,
+            "is_deafened": False,
+            "is_streaming": False,
+        }
+    )
+
+
+@message_handler("signal", rate_class="signal")
+async def handle_signal(ws, session, data):
+    """Пересылка сигнального сообщения конкретному пиру"""
+    await send_to_target(
+        target_uuid=data.get("target"),
+        sender_ws=ws,
+        message={
+            "type": "signal",
+            "sender": session["user_uuid"],
+            "data": data.get("data"),
+        },
+    )
+
+
+@message_handler("user_status_update", rate_class="presence")
+async def handle_user_status_update(ws, session, data):
+    """Обновление статуса пользователя (микрофон/звук)"""
+    user_uuid = session["user_uuid"]
+    username = session["username"]
+    room_name = session["status_room"]
+    current_room = data.get("room", False)
+    is_mic_muted = data.get("is_mic_muted", False)
+    is_deafened = data.get("is_deafened", False)
+    is_streaming = data.get("is_streaming", False)
+    if current_room != room_name:
+        if room_name and rooms_user_statuses.get(room_name, dict()).pop(username, None):
+            publish_presence(
+                {
+                    "room": f"!{room_name}",
+                    "user_uuid": user_uuid,
+                    "username": username,
+                    "is_mic_muted": False,
+                    "is_deafened": False,
+                    "is_streaming": False,
+                }
+            )
+        room_name = session["status_room"] = current_room
+    if room_name and rooms_user_statuses.get(room_name, dict()).get(
+        username
+    ):
+        rooms_user_statuses[room_name][username].update(
+            {
+                "is_mic_muted": is_mic_muted,
+                "is_deafened": is_deafened,
+                "is_streaming": is_streaming,
+            }
+        )
 
-                elif message_type == "chat_message":
-                    # Текстовое сообщение чата (глобальный чат, не зависит от комнаты)
-                    message_content = data.get("content")
-                    message_type_db = data.get("message_type", "text")
-
-                    if message_content:
-                        # Получаем информацию о пользователе из БД
-                        user = db.get_user_by_uuid(user_uuid)
-                        username = user["username"] if user else "Unknown"
-
-                        # Обновляем информацию о пользователе в соединении
-                        if ws in connections:
-                            connections[ws]["user_uuid"] = user_uuid
-                            connections[ws]["username"] = username
-                            logger.info(
-                                f"✓ Обновлена информация о пользователе: {username}"
-                            )
-
-                        # Для медиа-сообщений не сохраняем в БД, т.к. они уже сохранены при загрузке файла
-                        if message_type_db == "media":
-                            logger.info(
-                                f"Медиа-сообщение получено (уже сохранено при загрузке): {message_content[:50]}..."
-                            )
-                            # Используем текущее время для сообщения
-                            message_datetime = datetime.now(timezone.utc).isoformat()
-                        else:
-                            # Для текстовых сообщений сохраняем в БД
-                            try:
-                                message_id = db.add_message(
-                                    message_type_db, message_content, user_uuid
-                                )
-                                logger.info(
-                                    f"Сообщение сохранено в БД (ID: {message_id}): {message_content[:50]}..."
-                                )
-                            except Exception as e:
-                                logger.info(f"Ошибка сохранения сообщения: {e}")
-                                return
-
-                            # Получаем сохраненное сообщение из БД
-                            messages = db.get_recent_messages(1)
-                            message_datetime = None
-                            if messages and messages[0]["id"] == message_id:
-                                message_datetime = messages[0]["datetime"]
-
-                        # Рассылаем сообщение всем подключенным клиентам (глобальный чат)
-                        message_to_send = {
-                            "type": "chat_message",
-                            "content": message_content,
-                            "message_type": message_type_db,
-                            "user_uuid": user_uuid,
-                            "username": username,
-                            "datetime": message_datetime
-                            or datetime.now(timezone.utc).isoformat(),
-                        }
-
-                        # Отправляем всем подключенным WebSocket клиентам
-                        sent_count = 0
-                        for conn in connections:
-                            if not conn.closed:
-                                try:
-                                    await conn.send_json(message_to_send)
-                                    sent_count += 1
-                                except Exception as e:
-                                    logger.info(f"Ошибка отправки сообщения: {e}")
-
-                        logger.info(
-                            f"Сообщение отправлено {sent_count}/{len(connections)} клиентам, username: {username}"
-                        )
-
-                elif message_type == "leave":
-                    # Пользователь покидает комнату
-                    if ws in connections:
-                        room_name = connections[ws]["room"]
-
-                        # Удаляем из комнаты
-                        if room_name in rooms and ws in rooms[room_name]:
-                            rooms[room_name].remove(ws)
-                            if not rooms[room_name]:
-                                del rooms[room_name]
-
-                        # Уведомляем других участников
-                        if room_name:
-                            await broadcast_to_room(
-                                room=room_name,
-                                message={
-                                    "type": "peer_left",
-                                    "peer_uuid": user_uuid,
-                                    "username": username,
-                                },
-                                exclude_ws=ws,
-                            )
-                            await broadcast_to_server(
-                                {
-                                    "type": "user_status_update",
-                                    "room": f"!{room_name}",
-                                    "user_uuid": user_uuid,
-                                    "username": username,
-                                    "is_mic_muted": False,
-                                    "is_deafened": False,
-                                    "is_streaming": False,
-                                }
-                            )
-                            del rooms_user_statuses[room_name][username]
-
-                        # Сбрасываем комнату в соединении, но сохраняем остальную информацию
-                        connections[ws]["room"] = None
-
-                        # Очищаем состояние автовосстановления
-                        if user_uuid in user_last_room:
-                            del user_last_room[user_uuid]
-
-                        logger.info(
-                            f"✓ Пользователь {username} покинул комнату {room_name}"
-                        )
-                else:
-                    logger.info(f"Unrecognized message_type {message_type}")
+        # Рассылаем статус всем участникам комнаты
+        publish_presence(
+            {
+                "room": room_name,
+                "user_uuid": user_uuid,
+                "username": username,
+                "is_mic_muted": is_mic_muted,
+                "is_deafened": is_deafened,
+                "is_streaming": is_streaming,
+            }
+        )
 
-    except Exception:
-        logger.exception("WebSocket error")
-    finally:
-        # Очистка при отключении
-        if ws in connections:
-            info = connections.pop(ws)
-            room_name = info["room"]
-            username = info["username"]
-
-            if room_name in rooms and ws in rooms[room_name]:
-                rooms[room_name].remove(ws)
-                if not rooms[room_name]:
-                    del rooms[room_name]
-
-            if connections.get(ws, dict()).get("room"):
-                # Уведомляем о выходе комнату
-                await broadcast_to_room(
-                    room=connections[ws]["room"],
-                    message={
-                        "type": "peer_left",
-                        "peer_uuid": user_uuid,
-                        "username": username,
-                    },
-                    exclude_ws=ws,
-                )
-            if (
-                room_name
-                and rooms_user_statuses.get(room_name)
-                and rooms_user_statuses[room_name].get(username)
-            ):
-                del rooms_user_statuses[room_name][username]
-                await broadcast_to_server(
-                    {
-                        "type": "user_status_update",
-                        "room": f"!{room_name}",
-                        "user_uuid": user_uuid,
-                        "username": username,
-                        "is_mic_muted": False,
-                        "is_deafened": False,
-                        "is_streaming": False,
-                    }
-                )
-
-            # ВАЖНО: НЕ очищаем user_last_room здесь!
-            # Это позволяет автовосстановить комнату при переподключении
-            # user_last_room очищается только при явном leave
-            if last_user_status := user_last_room.get(user_uuid):
-                last_user_status['time'] = datetime.now(timezone.utc).timestamp()
-    return ws
+
+@message_handler("presence_sync", rate_class="presence")
+async def handle_presence_sync(ws, session, data):
+    """Клиент заметил пропуск версии статусов"""
+    sync_presence(ws, data.get("epoch"), data.get("since"))
+
+
+@message_handler("screen_share_request", rate_class="screen")
+async def handle_screen_share_request(ws, session, data):
+    logger.info("screen_share_request")
+
+    await send_to_target(
+        target_uuid=data.get("target"),
+        sender_ws=ws,
+        message={
+            "type": "screen_share_request",
+            "user_uuid": session["user_uuid"],
+        },
+    )
+
+
+@message_handler("screen_share_stop_request", rate_class="screen")
+async def handle_screen_share_stop_request(ws, session, data):
+    logger.info("screen_share_stop_request")
+
+
+@message_handler("screen_share_stop", rate_class="screen")
+async def handle_screen_share_stop(ws, session, data):
+    """Пользователь остановил демонстрацию экрана"""
+    # Уведомляем всех участников комнаты
+    await broadcast_to_server(
+        {
+            "type": "screen_share_stop",
+            "peer_uuid": session["user_uuid"],
+            "username": session["username"],
+        },
+        exclude_ws=ws,
+    )
+
+
+@message_handler("screen_signal", rate_class="screen")
+async def handle_screen_signal(ws, session, data):
+    """Пересылка сигнального сообщения для демонстрации экрана"""
+    await send_to_target(
+        target_uuid=data.get("target"),
+        sender_ws=ws,
+        message={
+            "type": "screen_signal",
+            "sender": session["user_uuid"],
+            "data": data.get("data"),
+        },
+    )
+
+
+@message_handler("chat_message", rate_class="chat")
+async def handle_chat_message(ws, session, data):
+    """Текстовое сообщение чата (глобальный чат, не зависит от комнаты)"""
+    user_uuid = session["user_uuid"]
+    message_content = data.get("content")
+    message_type_db = data.get("message_type", "text")
+
+    if not message_content:
+        return
+    if not isinstance(message_content, str) or not isinstance(message_type_db, str):
+        logger.warning(f"Некорректное сообщение чата от {session['username']}: {data!r:.100}")
+        return
+
+    # Получаем информацию о пользователе из БД
+    user = await async_db.get_user_by_uuid(user_uuid)
+    username = user["username"] if user else "Unknown"
+
+    # Обновляем информацию о пользователе в соединении
+    session["username"] = username
+    logger.info(
+        f"✓ Обновлена информация о пользователе: {username}"
+    )
+
+    # Для медиа-сообщений не сохраняем в БД, т.к. они уже сохранены при загрузке файла
+    if message_type_db == "media":
+        logger.info(
+            f"Медиа-сообщение получено (уже сохранено при загрузке): {message_content[:50]}..."
+        )
+        # Используем текущее время для сообщения
+        message_datetime = datetime.now(timezone.utc).isoformat()
+    else:
+        # Для текстовых сообщений сохраняем в БД
+        try:
+            message_id, message_datetime = await async_db.add_message(
+                message_type_db, message_content, user_uuid
+            )
+            logger.info(
+                f"Сообщение сохранено в БД (ID: {message_id}): {message_content[:50]}..."
+            )
+        except Exception as e:
+            logger.info(f"Ошибка сохранения сообщения: {e}")
+            await ws.close()
+            return
+
+    # Рассылаем сообщение всем подключенным клиентам (глобальный чат)
+    message_to_send = {
+        "type": "chat_message",
+        "content": message_content,
+        "message_type": message_type_db,
+        "user_uuid": user_uuid,
+        "username": username,
+        "datetime": message_datetime
+        or datetime.now(timezone.utc).isoformat(),
+    }
+
+    # Отправляем всем подключенным WebSocket клиентам
+    sent_count = broadcast_to_all(message_to_send)
+
+    logger.info(
+        f"Сообщение отправлено {sent_count}/{len(connections)} клиентам, username: {username}"
+    )
+
+
+@message_handler("leave", rate_class="presence")
+async def handle_leave(ws, session, data):
+    """Пользователь покидает комнату"""
+    user_uuid = session["user_uuid"]
+    username = session["username"]
+    room_name = session["status_room"] = session["room"]
+
+    # Удаляем из комнаты
+    if room_name in rooms and ws in rooms[room_name]:
+        rooms[room_name].remove(ws)
+        if not rooms[room_name]:
+            del rooms[room_name]
+
+    # Сбрасываем комнату в соединении, но сохраняем остальную информацию
+    session["room"] = None
+
+    # Пользователь остается в комнате с другой сессии: для участников ничего не изменилось
+    if room_name and user_in_room(user_uuid, room_name):
+        logger.info(f"✓ Сессия пользователя {username} покинула комнату {room_name}, другие сессии остаются")
+        return
+
+    # Уведомляем других участников
+    if room_name:
+        await broadcast_to_room(
+            room=room_name,
+            message={
+                "type": "peer_left",
+                "peer_uuid": user_uuid,
+                "username": username,
+            },
+            exclude_ws=ws,
+        )
+        publish_presence(
+            {
+                "room": f"!{room_name}",
+                "user_uuid": user_uuid,
+                "username": username,
+                "is_mic_muted": False,
+                "is_deafened": False,
+                "is_streaming": False,
+            }
+        )
+        rooms_user_statuses.get(room_name, {}).pop(username, None)
+
+    # Очищаем состояние автовосстановления
+    forget_last_room(user_uuid)
+
+    logger.info(
+        f"✓ Пользователь {username} покинул комнату {room_name}"
+    )
+
+
+def send_message(ws, message):
+    """Поставить сообщение в очередь отправки одного соединения"""
+    return fan_out([ws], message) == 1
+
+
+def sync_presence(ws, epoch, version):
+    """Отправить клиенту пакеты статусов новее его версии или полный снимок"""
+    try:
+        version = int(version) if version is not None else None
+    except (TypeError, ValueError):
+        version = None
+
+    info = connections.get(ws)
+    if info is None:
+        return
+    deltas = presence.deltas_since(epoch, version)
+    if deltas is None:
+        info["outbox"].put(presence.snapshot_frame(rooms_user_statuses, info["codec"]), "user_status_total")
+        return
+    for message in deltas:
+        send_message(ws, message)
+
+
+def fan_out(recipients, message):
+    """Разослать событие получателям: сообщение кодируется один раз на каждый кодек
+    получателей, готовый кадр ставится в очередь отправки каждого получателя.
+
+    Возвращает число принятых кадров и обновляет fanout_stats
+    (число событий, суммарный/максимальный размер рассылки, время кодирования).
+    """
+    message_type = message.get("type")
+    frames = {}  # имя кодека -> кадр
+    encode_seconds = 0.0
+    queued = 0
+    for conn in recipients:
+        info = connections.get(conn)
+        if info is None:
+            continue
+        codec = info["codec"]
+        frame = frames.get(codec.name)
+        if frame is None:
+            started = time.perf_counter()
+            frame = frames[codec.name] = codec.encode(message)
+            encode_seconds += time.perf_counter() - started
+        if info["outbox"].put(frame, message_type):
+            queued += 1
+
+    fanout_stats["events"] += 1
+    fanout_stats["recipients"] += queued
+    fanout_stats["max_recipients"] = max(fanout_stats["max_recipients"], queued)
+    fanout_stats["encode_seconds"] += encode_seconds
+    ws_fanout_recipients.observe(queued, message_type)
+    return queued
+
+
+def broadcast_presence(message):
+    """Разослать всем пакет изменений статусов пользователей"""
+    fan_out(list(connections), message)
+
+
+presence = PresenceAggregator(broadcast_presence)
+
+
+def publish_presence(update):
+    """Опубликовать изменение статуса локальной сессии для своих клиентов и других воркеров"""
+    presence.publish(update)
+    backplane.publish({"kind": "presence", "update": update})
+
+
+def broadcast_to_all(message, exclude_ws=None):
+    """Разослать сообщение всем клиентам всех воркеров, вернуть число локальных получателей"""
+    backplane.publish({"kind": "all", "message": message})
+    return fan_out([conn for conn in connections if conn != exclude_ws], message)
 
 
 async def broadcast_to_server(message, exclude_ws=None):
     """Отправка сообщения всем, кроме исключенного WebSocket"""
-    tasks = [
-        asyncio.create_task(conn.send_json(message))
-        for conn in connections.keys()
-        if conn != exclude_ws and not conn.closed
-    ]
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+    broadcast_to_all(message, exclude_ws)
 
 
 async def broadcast_to_room(room, message, exclude_ws=None):
     """Отправка сообщения всем в комнате, кроме исключенного WebSocket"""
+    backplane.publish({"kind": "room", "room": room, "message": message})
     if room not in rooms:
         return
-    tasks = [
-        asyncio.create_task(conn.send_json(message))
-        for conn in rooms[room]
-        if conn != exclude_ws and not conn.closed
+    fan_out([conn for conn in rooms[room] if conn != exclude_ws], message)
+
+
+def room_is_active(room_name):
+    """Есть ли в комнате участники на этом или другом воркере"""
+    return room_name in rooms or bool(backplane.clustered and rooms_user_statuses.get(room_name))
+
+
+def room_peers(room_name, ws):
+    """Участники комнаты для нового участника: локальные сессии и сессии других воркеров"""
+    peers = [
+        {
+            "username": connections[conn]["username"],
+            "user_uuid": connections[conn].get("user_uuid", ""),
+        }
+        for conn in rooms.get(room_name, ())
+        if conn != ws
     ]
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+    for username, status in rooms_user_statuses.get(room_name, {}).items():
+        if (room_name, username) in remote_presence:
+            peers.append({"username": username, "user_uuid": status["user_uuid"]})
+    return peers
+
+
+def user_in_room(user_uuid, room_name):
+    """Есть ли у пользователя еще одна живая сессия в комнате (другая вкладка или устройство)"""
+    return any(
+        connections[conn]["room"] == room_name
+        for conn in user_sessions.get(user_uuid, ())
+        if conn in connections
+    )
+
+
+def remember_last_room(user_uuid, data):
+    """Сохранить комнату пользователя для автовосстановления на любом воркере"""
+    user_last_room.put(user_uuid, data)
+    backplane.publish({"kind": "last_room", "user_uuid": user_uuid, "data": data})
+
+
+def forget_last_room(user_uuid):
+    user_last_room.discard(user_uuid)
+    backplane.publish({"kind": "last_room", "user_uuid": user_uuid, "data": None})
+
+
+def find_target_sessions(target_uuid, sender_ws=None):
+    """Найти сессии получателя по индексу user_uuid.
 
+    Если у пользователя открыто несколько вкладок/устройств, сигналинг идет в сессии,
+    находящиеся в той же комнате, что и отправитель; если таких нет - во все сессии.
+    """
+    sessions = [conn for conn in user_sessions.get(target_uuid, ()) if not conn.closed]
+    if len(sessions) > 1 and sender_ws in connections:
+        sender_room = connections[sender_ws]["room"]
+        in_room = [conn for conn in sessions if connections[conn]["room"] == sender_room]
+        if in_room:
+            return in_room
+    return sessions
 
-async def send_to_target(target_uuid, message):
+
+async def send_to_target(target_uuid, message, sender_ws=None):
+    target_sessions = []
     try:
-        target_ws = None
         if target_uuid:
-            for conn, info in connections.items():
-                if info["user_uuid"] == target_uuid:
-                    target_ws = conn
-                    break
-            logger.info(f"target_ws={target_ws}")
-            if target_ws is not None:
-                await target_ws.send_json(message)
+            target_sessions = find_target_sessions(target_uuid, sender_ws)
+            if target_sessions:
+                fan_out(target_sessions, message)
+            elif backplane.clustered:
+                # Получатель может быть подключен к другому воркеру
+                backplane.publish({"kind": "target", "user_uuid": target_uuid, "message": message})
             else:
-                logger.bind(target_uuid=target_uuid, connections=connections).warning(
-                    "Target WS not found!"
-                )
+                ws_target_misses_total.inc(message.get("type"))
+                logger.bind(target_uuid=target_uuid).warning("Target WS not found!")
 
     except Exception:
-        logger.bind(target_uuid=target_uuid, target_ws=target_ws).exception(
+        logger.bind(target_uuid=target_uuid, target_sessions=target_sessions).exception(
             "send_to_target exception"
         )
 
 
 async def _cleanup_connection(ws):
-    pass
+    """Очистка при отключении: сессия, комната и статусы; повторный вызов ничего не делает"""
+    info = unregister_session(ws)
+    if info is None:
+        return
+    room_name = info["room"]
+    username = info["username"]
+    user_uuid = info["user_uuid"]
+
+    if room_name in rooms and ws in rooms[room_name]:
+        rooms[room_name].remove(ws)
+        if not rooms[room_name]:
+            del rooms[room_name]
+
+    # Другая вкладка или устройство пользователя еще в комнате: участники его не теряют
+    if room_name and user_in_room(user_uuid, room_name):
+        return
+
+    if room_name:
+        # Уведомляем о выходе комнату
+        await broadcast_to_room(
+            room=room_name,
+            message={
+                "type": "peer_left",
+                "peer_uuid": user_uuid,
+                "username": username,
+            },
+            exclude_ws=ws,
+        )
+    if (
+        room_name
+        and rooms_user_statuses.get(room_name)
+        and rooms_user_statuses[room_name].get(username)
+    ):
+        del rooms_user_statuses[room_name][username]
+        publish_presence(
+            {
+                "room": f"!{room_name}",
+                "user_uuid": user_uuid,
+                "username": username,
+                "is_mic_muted": False,
+                "is_deafened": False,
+                "is_streaming": False,
+            }
+        )
+
+    # ВАЖНО: НЕ очищаем user_last_room здесь!
+    # Это позволяет автовосстановить комнату при переподключении
+    # user_last_room очищается при явном leave или по истечении окна RESUME_WINDOW,
+    # которое начинается, когда в комнате не остается сессий пользователя
+    last_user_status = user_last_room.get(user_uuid)
+    if last_user_status and not user_in_room(user_uuid, last_user_status["room"]):
+        remember_last_room(user_uuid, {**last_user_status, "time": datetime.now(timezone.utc).timestamp()})
+
+
+async def expire_session(ws):
+    """Отключить соединение, не ответившее на heartbeat, через обычную очистку"""
+    info = connections.get(ws)
+    if info is not None:
+        logger.info(f"Соединение {info['username']} не отвечает на ping, отключаем")
+    await _cleanup_connection(ws)
+    if not ws.closed:
+        task = asyncio.create_task(ws.close(code=WSCloseCode.GOING_AWAY, message=b'Heartbeat timeout'))
+        _closing_tasks.add(task)
+        task.add_done_callback(_closing_tasks.discard)
+
+
+async def drain_connections(timeout: float = DRAIN_TIMEOUT):
+    """Остановка сервера: перестать принимать /ws, подсказать клиентам задержку переподключения и закрыть соединения.
+
+    Задержки случайны и размазывают переподключения по окну, поэтому перезапущенный
+    сервер получает клиентов постепенно, а не все сразу.
+    """
+    admission.draining = True
+    sessions = [ws for ws in connections if not ws.closed]
+    if not sessions:
+        return
+    logger.info(f"Остановка: {len(sessions)} соединений получат подсказку переподключения")
+    for ws in sessions:
+        send_message(ws, {"type": "reconnect", "delay_ms": int(reconnect_delay(len(sessions)) * 1000)})
 
+    # Ждем, пока подсказка уйдет из очередей отправки
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline and any(len(info["outbox"]) for info in list(connections.values())):
+        await asyncio.sleep(0.05)
 
-async def send_periodic_message():
-    """Отправка периодического сообщения всем подключенным WebSocket клиентам"""
-    message = {"type": "ping"}
+    closing = [ws.close(code=WSCloseCode.SERVICE_RESTART, message=b'Server restart') for ws in sessions]
+    try:
+        await asyncio.wait_for(asyncio.gather(*closing, return_exceptions=True), max(0.1, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        logger.warning("Не все WebSocket соединения закрылись до остановки")
+
+
+def send_heartbeat(sessions, message):
+    """Разослать ping слоту колеса одним кадром"""
+    fan_out(sessions, message)
+
+
+_closing_tasks = set()
+heartbeat = HeartbeatWheel(send_heartbeat, expire_session)
+admission = AdmissionGate()
+
+registry.gauge_callback('ws_connections', 'Открытые WebSocket соединения', lambda: len(connections))
+registry.gauge_callback('ws_users', 'Пользователи хотя бы с одной сессией', lambda: len(user_sessions))
+registry.gauge_callback('rooms', 'Голосовые комнаты с участниками', lambda: len(rooms))
+registry.gauge_callback('user_last_room', 'Записи для автовосстановления комнаты', lambda: len(user_last_room))
+registry.counter_callback('user_last_room_expired_total', 'Записи автовосстановления, удаленные по истечении окна',
+                          lambda: user_last_room.expired)
+registry.gauge_callback('ws_queued_frames', 'Кадры в очередях отправки всех соединений',
+                        lambda: sum(len(info["outbox"]) for info in list(connections.values())))
+registry.counter_callback('ws_fanout_encode_seconds_total', 'Время кодирования рассылок',
+                          lambda: fanout_stats["encode_seconds"])
+registry.counter_callback('ws_heartbeat_timeouts_total', 'Соединения, отключенные по heartbeat',
+                          lambda: heartbeat.timeouts)
+registry.gauge_callback('ws_handshakes_active', 'Рукопожатия /ws в обработке', lambda: admission.active)
+registry.gauge_callback('ws_handshakes_waiting', 'Рукопожатия /ws в очереди', lambda: admission.waiting)
+registry.counter_callback('ws_handshakes_rejected_total', 'Подключения /ws, отклоненные с 503',
+                          lambda: admission.rejected)
+registry.gauge_callback('presence_version', 'Версия пакетов статусов пользователей', lambda: presence.version)
+
+
+def _apply_remote_presence(worker, update):
+    """Применить изменение статуса сессии другого воркера к локальной копии"""
+    room_name = update["room"]
+    username = update["username"]
+    if room_name.startswith("!"):
+        room_name = room_name[1:]
+        if remote_presence.pop((room_name, username), None) is None:
+            return
+        room_statuses = rooms_user_statuses.get(room_name, {})
+        room_statuses.pop(username, None)
+        if not room_statuses:
+            rooms_user_statuses.pop(room_name, None)
+    else:
+        remote_presence[(room_name, username)] = worker
+        rooms_user_statuses.setdefault(room_name, {})[username] = {
+            "user_uuid": update["user_uuid"],
+            "is_mic_muted": update["is_mic_muted"],
+            "is_deafened": update["is_deafened"],
+            "is_streaming": update["is_streaming"],
+        }
+    presence.publish(update)
+
+
+def _forget_worker(worker):
+    """Убрать статусы сессий воркера, который завершился или перестал отвечать"""
+    worker_seen.pop(worker, None)
+    for (room_name, username), owner in list(remote_presence.items()):
+        if owner != worker:
+            continue
+        status = rooms_user_statuses.get(room_name, {}).get(username, {})
+        _apply_remote_presence(worker, {
+            "room": f"!{room_name}",
+            "user_uuid": status.get("user_uuid"),
+            "username": username,
+            "is_mic_muted": False,
+            "is_deafened": False,
+            "is_streaming": False,
+        })
+
+
+def _announce_local_presence():
+    """Разослать статусы своих сессий воркеру, который только что подключился к шине"""
+    for room_name, statuses in rooms_user_statuses.items():
+        for username, status in statuses.items():
+            if (room_name, username) in remote_presence:
+                continue
+            backplane.publish({"kind": "presence", "update": {"room": room_name, "username": username, **status}})
+
+
+def on_backplane_message(message):
+    """Обработать сообщение другого воркера"""
+    kind = message["kind"]
+    worker = message["worker"]
+    worker_seen[worker] = asyncio.get_running_loop().time()
+
+    if kind == "room":
+        room = rooms.get(message["room"])
+        if room:
+            fan_out(list(room), message["message"])
+    elif kind == "all":
+        fan_out(list(connections), message["message"])
+    elif kind == "target":
+        sessions = find_target_sessions(message["user_uuid"])
+        if sessions:
+            fan_out(sessions, message["message"])
+    elif kind == "presence":
+        _apply_remote_presence(worker, message["update"])
+    elif kind == "last_room":
+        if message["data"] is None:
+            user_last_room.discard(message["user_uuid"])
+        else:
+            user_last_room.put(message["user_uuid"], message["data"])
+    elif kind == "db":
+        db.apply_remote_change(message["change"], message["key"])
+    elif kind == "hello":
+        # Перезапущенный воркер приходит с тем же id: сессии упавшего процесса уже не существуют
+        _forget_worker(worker)
+        worker_seen[worker] = asyncio.get_running_loop().time()
+        _announce_local_presence()
+    elif kind == "bye":
+        _forget_worker(worker)
+
+
+async def _backplane_heartbeat():
+    """Сообщать другим воркерам, что этот жив, и забывать сессии молчащих воркеров"""
+    loop = asyncio.get_running_loop()
     while True:
-        await asyncio.sleep(25)  # Ждем 25 секунд
-
-        # Отправляем сообщение всем подключенным WebSocket клиентам
-        for ws in list(connections.keys()):
-            if not ws.closed:
-                try:
-                    await ws.send_json(message)
-                    continue
-                except Exception as e:
-                    logger.info(f"Ошибка отправки периодического сообщения: {e}")
-            if ws in connections:
-                connections.pop(ws)
+        await asyncio.sleep(BACKPLANE_HEARTBEAT)
+        backplane.publish({"kind": "alive"})
+        deadline = loop.time() - BACKPLANE_HEARTBEAT * 3
+        for worker, seen in list(worker_seen.items()):
+            if seen < deadline:
+                logger.warning(f"Воркер {worker} не отвечает, его сессии убраны из статусов")
+                _forget_worker(worker)
+
+
+async def start_cluster(bus):
+    """Подключить воркер к шине: рассылки, статусы и изменения базы идут другим воркерам"""
+    global backplane, _backplane_task
+    backplane = bus
+    await backplane.start(on_backplane_message)
+    async_db.on_change = lambda kind, key: backplane.publish({"kind": "db", "change": kind, "key": key})
+    backplane.publish({"kind": "hello"})
+    _backplane_task = asyncio.create_task(_backplane_heartbeat())
+    logger.info(f"Воркер {backplane.worker_id} подключен к шине")
+
+
+async def stop_cluster():
+    """Попрощаться с другими воркерами и закрыть шину"""
+    if _backplane_task is not None:
+        _backplane_task.cancel()
+    backplane.publish({"kind": "bye"})
+    await backplane.close()
+
+
+backplane = Backplane()
+worker_seen = {}  # id воркера -> время последнего сообщения от него
+_backplane_task = None
+
+registry.counter_callback('backplane_published_total', 'Сообщения, отправленные в шину воркеров',
+                          lambda: backplane.published)
+registry.counter_callback('backplane_received_total', 'Сообщения, полученные из шины воркеров',
+                          lambda: backplane.received)
@@ -0,0 +1,171 @@
+# media_gc.py
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+from loguru import logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from config import MEDIA_DIR, MEDIA_GC_INTERVAL, MEDIA_GC_BATCH_SIZE, MEDIA_GC_MAX_RETRIES
+from metrics import registry
+
+
+class MediaFileLock:
+    """Блокировка файлов media_dir между потоками и процессами-воркерами.
+
+    Внутри процесса - threading.Lock, между процессами - flock на служебном файле.
+    Файл блокировки открывается в каждом процессе заново: дескриптор, унаследованный
+    от родителя, разделял бы одну блокировку. Без fcntl (Windows) работает
+    только блокировка потоков - там сервер запускается одним процессом.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is None:
+            return self
+        try:
+            if self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._thread_lock.release()
+
+
+class MediaReclaimer:
+    """Фоновое удаление осиротевших медиа файлов.
+
+    Путь записи сообщений только ставит файл в очередь, а удаление идет
+    пачками в отдельном потоке с повторными попытками при ошибках. Файл, на
+    который снова появилась ссылка (in_use), не удаляется.
+    """
+
+    def __init__(self, media_dir: str, interval: float = 5, batch_size: int = 100, max_retries: int = 5):
+        self.media_dir = media_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._queue: "deque[Tuple[str, int]]" = deque()  # (путь, число неудачных попыток)
+        self._lock = threading.Lock()
+        # Проверка и удаление файла атомарны относительно place_upload во всех воркерах
+        self.file_lock = MediaFileLock(os.path.join(media_dir, '.media.lock'))
+        self.in_use: Optional[Callable[[str], bool]] = None  # имя файла -> есть ли на него ссылки
+        self.files_reclaimed = 0
+        self.bytes_reclaimed = 0
+        self.failures = 0
+
+    def resolve_path(self, media_url: str) -> Optional[str]:
+        """Преобразовать URL или имя медиа файла в абсолютный путь внутри media_dir"""
+        filename = os.path.basename(media_url)
+        if not filename:
+            return None
+        return os.path.join(self.media_dir, filename)
+
+    def enqueue(self, media_url: str):
+        """Поставить файл в очередь на удаление (можно вызывать из любого потока)"""
+        file_path = self.resolve_path(media_url)
+        if file_path is None:
+            return
+        with self._lock:
+            self._queue.append((file_path, 0))
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def _take_batch(self) -> List[Tuple[str, int]]:
+        with self._lock:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            return batch
+
+    def _delete_batch(self, batch: List[Tuple[str, int]]) -> Tuple[int, int, List[Tuple[str, int]]]:
+        """Удалить пачку файлов, вернуть (удалено файлов, освобождено байт, неудачные)"""
+        files = 0
+        reclaimed = 0
+        failed = []
+        for file_path, attempts in batch:
+            try:
+                with self.file_lock:
+                    if self.in_use is not None and self.in_use(os.path.basename(file_path)):
+                        continue
+                    size = os.path.getsize(file_path)
+                    os.remove(file_path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.info(f"Ошибка при удалении медиа файла {file_path}: {e}")
+                failed.append((file_path, attempts + 1))
+                continue
+            files += 1
+            reclaimed += size
+        return files, reclaimed, failed
+
+    async def reclaim(self):
+        """Обработать все файлы, находящиеся в очереди на момент вызова"""
+        for _ in range(-(-self.pending // self.batch_size)):
+            batch = self._take_batch()
+            if not batch:
+                break
+
+            files, reclaimed, failed = await asyncio.to_thread(self._delete_batch, batch)
+            self.files_reclaimed += files
+            self.bytes_reclaimed += reclaimed
+
+            for file_path, attempts in failed:
+                if attempts < self.max_retries:
+                    with self._lock:
+                        self._queue.append((file_path, attempts))
+                else:
+                    self.failures += 1
+                    logger.warning(f"Медиа файл не удален после {attempts} попыток: {file_path}")
+
+            if files:
+                logger.info(
+                    f"Удалено медиа файлов: {files}, освобождено {reclaimed} байт "
+                    f"(всего {self.bytes_reclaimed} байт)"
+                )
+
+    async def run(self):
+        """Периодически разбирать очередь удаления"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reclaim()
+            except Exception:
+                logger.exception("Ошибка фонового удаления медиа файлов")
+
+
+media_reclaimer = MediaReclaimer(
+    MEDIA_DIR,
+    interval=MEDIA_GC_INTERVAL,
+    batch_size=MEDIA_GC_BATCH_SIZE,
+    max_retries=MEDIA_GC_MAX_RETRIES
+)
+
+registry.gauge_callback('media_gc_pending', 'Медиа файлов в очереди на удаление', lambda: media_reclaimer.pending)
+registry.counter_callback('media_gc_files_total', 'Удалено медиа файлов', lambda: media_reclaimer.files_reclaimed)
+registry.counter_callback('media_gc_bytes_total', 'Освобождено байт медиа файлов', lambda: media_reclaimer.bytes_reclaimed)
+registry.counter_callback('media_gc_failures_total', 'Медиа файлы, не удаленные после всех попыток',
+                          lambda: media_reclaimer.failures)
@@ -0,0 +1,167 @@
+# metrics.py
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Границы гистограмм по умолчанию (секунды)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+BYTES_BUCKETS = (1024, 16 * 1024, 128 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence, extra: str = '') -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class Counter:
+    """Монотонный счетчик с необязательными метками"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labelvalues, amount: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labelvalues, value in list(self._values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами; наблюдение - один bisect и два сложения"""
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, list] = {}  # метки -> [счетчики по корзинам + +Inf, сумма]
+
+    def observe(self, value: float, *labelvalues):
+        series = self._values.get(labelvalues)
+        if series is None:
+            series = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labelvalues, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                labels = _format_labels(self.labelnames, labelvalues, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class CallbackMetric:
+    """Gauge или counter, значение которого читается из состояния сервера в момент сбора.
+
+    callback возвращает число или итерируемое из пар (значения меток, число).
+    """
+
+    def __init__(self, name: str, documentation: str, callback: Callable, labelnames: Sequence[str] = (),
+                 metric_type: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.metric_type = metric_type
+
+    def _samples(self) -> Iterable[Tuple[tuple, float]]:
+        value = self.callback()
+        if isinstance(value, (int, float)):
+            return [((), value)]
+        return value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for labelvalues, value in self._samples():
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class MetricsRegistry:
+    """Набор метрик сервера в текстовом формате Prometheus"""
+
+    def __init__(self, prefix: str = ''):
+        self.prefix = prefix
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  labelnames: Sequence[str] = ()) -> Histogram:
+        return self._register(Histogram(self.prefix + name, documentation, buckets, labelnames))
+
+    def gauge_callback(self, name: str, documentation: str, callback: Callable,
+                       labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self._register(CallbackMetric(self.prefix + name, documentation, callback, labelnames))
+
+    def counter_callback(self, name: str, documentation: str, callback: Callable,
+                         labelnames: Sequence[str] = ()) -> CallbackMetric:
+        return self._register(CallbackMetric(self.prefix + name, documentation, callback, labelnames, 'counter'))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry(prefix='bungaacord_')
+
+# Метрики горячих путей; gauges регистрируют модули, которым принадлежит состояние
+ws_messages_total = registry.counter(
+    'ws_messages_total', 'Входящие WebSocket сообщения по типу', ['type'])
+ws_fanout_recipients = registry.histogram(
+    'ws_fanout_recipients', 'Число получателей одной рассылки', SIZE_BUCKETS, ['type'])
+ws_send_seconds = registry.histogram(
+    'ws_send_seconds', 'Время от постановки кадра в очередь до записи в сокет')
+ws_target_misses_total = registry.counter(
+    'ws_target_misses_total', 'Сообщения send_to_target без активной сессии получателя', ['type'])
+ws_rtt_seconds = registry.histogram(
+    'ws_rtt_seconds', 'RTT клиента по ответу pong на heartbeat ping')
+rate_limited_total = registry.counter(
+    'rate_limited_total', 'Сообщения и загрузки, отклоненные лимитом частоты', ['class'])
+db_query_seconds = registry.histogram(
+    'db_query_seconds', 'Время запроса к базе данных с учетом ожидания в пуле потоков', labelnames=['method'])
+upload_size_bytes = registry.histogram(
+    'upload_size_bytes', 'Размер загруженных файлов', BYTES_BUCKETS, ['kind'])
+upload_duration_seconds = registry.histogram(
+    'upload_duration_seconds', 'Длительность обработки загрузки', labelnames=['kind'])
+upload_deduplicated_bytes_total = registry.counter(
+    'upload_deduplicated_bytes_total', 'Байты загрузок, уже хранившихся на диске', ['kind'])
+image_processing_seconds = registry.histogram(
+    'image_processing_seconds', 'Время обработки изображения в пуле процессов с учетом очереди', labelnames=['kind'])
+upload_throughput_bytes_per_second = registry.histogram(
+    'upload_throughput_bytes_per_second', 'Скорость приема загрузки', THROUGHPUT_BUCKETS, ['kind'])
@@ -1,11 +1,29 @@
 # server.py
 import ssl
 import asyncio
+import multiprocessing
+import signal
 from loguru import logger
 from aiohttp import web
 
-from config import ADMIN_UUID, ADMIN_USERNAME, CERT_FILEPATH, CURRENT_DIR, KEY_FILEPATH, PROTOCOL, HOST, PORT, MAX_CHAT_MESSAGES
-from database import db
+from config import (
+    ADMIN_UUID,
+    ADMIN_USERNAME,
+    CERT_FILEPATH,
+    CURRENT_DIR,
+    KEY_FILEPATH,
+    PROTOCOL,
+    HOST,
+    PORT,
+    MAX_CHAT_MESSAGES,
+    WORKERS,
+    BACKPLANE,
+    BACKPLANE_SOCKET,
+    BACKPLANE_REDIS_URL,
+    BACKPLANE_CHANNEL
+)
+from database import db, async_db
+from media_gc import media_reclaimer
 from handlers.middlewares import is_admin_middleware, is_user_middleware, cors_middleware
 from handlers.admin_handlers import (
     admin_handler,
@@ -21,14 +39,21 @@ from handlers.api_handlers import (
     get_turn_creds,
     upload_avatar
 )
-from handlers.websocket import websocket_handler, send_periodic_message
-
+from handlers.backplane import UnixSocketBroker, create_backplane
+from handlers.images import image_processor
+from handlers.websocket import (
+    websocket_handler,
+    heartbeat,
+    start_cluster,
+    stop_cluster,
+    drain_connections,
+    user_last_room
+)
+from handlers.metrics_handler import metrics_handler
 
-async def main():
-    """Основная функция запуска сервера"""
-    asyncio.create_task(send_periodic_message())
 
-    # Инициализируем базу данных
+def init_database():
+    """Подготовить базу данных: миграции, комнаты по умолчанию, администратор"""
     db.connect()
     db.init_tables()
     db.init_default_rooms()  # Инициализируем комнаты по умолчанию
@@ -43,17 +68,14 @@ async def main():
     else:
         logger.info("Переменные ADMIN_UUID и/или ADMIN_USERNAME не найдены в .env файле")
 
-    ssl_params = {}
-    if PROTOCOL == 'https':
-        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        ssl_context.check_hostname = False
-        ssl_context.load_cert_chain(CERT_FILEPATH, KEY_FILEPATH)
-        ssl_params['ssl_context'] = ssl_context
 
+def create_app():
+    """Собрать приложение со всеми маршрутами"""
     main_app = web.Application(middlewares=[cors_middleware])
 
     # Настройка маршрутов
     main_app.router.add_get('/ws', websocket_handler)
+    main_app.router.add_get('/metrics', metrics_handler)
     main_app.router.add_static('/static/', path=f'{CURRENT_DIR}/static', name='static')
 
     # API SECTION
@@ -73,11 +95,30 @@ async def main():
     admin_app.router.add_post('/api/users', create_user)
     admin_app.router.add_delete('/api/users', delete_user)
     main_app.add_subapp('/admin/', admin_app)
+    return main_app
+
+
+async def serve(backplane=None):
+    """Запустить сервер в текущем процессе; с шиной - как один из воркеров на общем порту"""
+    asyncio.create_task(heartbeat.run())
+    asyncio.create_task(media_reclaimer.run())
+    # Комнаты пользователей, отключившихся перед перезапуском
+    restored = user_last_room.restore(db.load_resume_sessions())
+    logger.info(f"Восстановлено записей автовосстановления: {restored}")
+    if backplane is not None:
+        await start_cluster(backplane)
+
+    ssl_params = {}
+    if PROTOCOL == 'https':
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.check_hostname = False
+        ssl_context.load_cert_chain(CERT_FILEPATH, KEY_FILEPATH)
+        ssl_params['ssl_context'] = ssl_context
 
     # Запуск сервера
-    runner = web.AppRunner(main_app)
+    runner = web.AppRunner(create_app())
     await runner.setup()
-    site = web.TCPSite(runner, HOST, PORT, **ssl_params)
+    site = web.TCPSite(runner, HOST, PORT, reuse_port=backplane is not None, **ssl_params)
     logger.info(f"Максимальное количество сообщений: {MAX_CHAT_MESSAGES}")
 
     await site.start()
@@ -86,10 +127,101 @@ async def main():
     try:
         await asyncio.Future()
     finally:
+        # Клиенты переподключаются с разбросом, а не все в момент запуска
+        await drain_connections()
+        if backplane is not None:
+            await stop_cluster()
         # Закрываем соединение с базой данных при завершении
+        await async_db.flush()
+        async_db.close()
+        db.save_resume_sessions(user_last_room.snapshot())
+        await media_reclaimer.reclaim()
+        image_processor.shutdown()
         db.close()
         logger.info("Соединение с базой данных закрыто")
 
 
+async def main():
+    """Основная функция запуска сервера"""
+    # SIGTERM (docker stop) останавливает сервер штатно: с подсказками клиентам и записью на диск
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    init_database()
+    await serve()
+
+
+def run_worker(index: int):
+    """Точка входа процесса-воркера"""
+    # Воркер останавливает главный процесс через SIGTERM, Ctrl+C в терминале воркеры не получают
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def worker_main():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        db.connect()
+        db.init_tables()
+        backplane = create_backplane(
+            BACKPLANE,
+            worker_id=f"w{index}",
+            socket_path=BACKPLANE_SOCKET,
+            redis_url=BACKPLANE_REDIS_URL,
+            channel=BACKPLANE_CHANNEL
+        )
+        await serve(backplane)
+
+    try:
+        asyncio.run(worker_main())
+    except asyncio.CancelledError:
+        pass
+
+
+async def run_cluster():
+    """Запустить WORKERS процессов на общем порту и брокер шины между ними"""
+    # Миграции и начальные данные выполняются один раз, до запуска воркеров
+    init_database()
+    db.close()
+
+    broker = None
+    if BACKPLANE == 'unix':
+        broker = UnixSocketBroker(BACKPLANE_SOCKET)
+        await broker.start()
+
+    context = multiprocessing.get_context('spawn')
+    workers = {}
+
+    def start_worker(index):
+        process = context.Process(target=run_worker, args=(index,), name=f'bungaacord-worker-{index}')
+        process.start()
+        workers[index] = process
+
+    for index in range(WORKERS):
+        start_worker(index)
+    logger.info(f"Запущено воркеров: {WORKERS}, шина: {BACKPLANE}")
+
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    try:
+        while not stopping.is_set():
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                for index, process in list(workers.items()):
+                    if not process.is_alive():
+                        logger.warning(f"Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                        start_worker(index)
+    finally:
+        # SIGTERM воркеру - штатная остановка с записью накопленных сообщений
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process in workers.values():
+            await asyncio.to_thread(process.join, 15)
+            if process.is_alive():
+                process.kill()
+        if broker is not None:
+            await broker.close()
+
+
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        asyncio.run(run_cluster() if WORKERS > 1 else main())
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# Модули бэкенда импортируются как в server.py: из каталога backend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('LOG_FILEPATH', os.path.join(tempfile.gettempdir(), 'bungaacord_tests.log'))
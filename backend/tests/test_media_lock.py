@@ -0,0 +1,38 @@
+import multiprocessing
+import time
+
+import pytest
+
+from media_gc import MediaFileLock, fcntl
+
+pytestmark = pytest.mark.skipif(
+    fcntl is None or 'fork' not in multiprocessing.get_all_start_methods(),
+    reason='межпроцессная блокировка требует fcntl и fork'
+)
+
+
+def hold_lock(lock, acquired, seconds):
+    with lock:
+        acquired.set()
+        time.sleep(seconds)
+
+
+def test_lock_excludes_other_processes(tmp_path):
+    lock = MediaFileLock(str(tmp_path / '.media.lock'))
+    # Родитель уже открыл файл блокировки: дочерний процесс должен открыть свой
+    with lock:
+        pass
+
+    context = multiprocessing.get_context('fork')
+    acquired = context.Event()
+    child = context.Process(target=hold_lock, args=(lock, acquired, 0.5))
+    child.start()
+    try:
+        assert acquired.wait(5)
+        started = time.monotonic()
+        with lock:
+            waited = time.monotonic() - started
+    finally:
+        child.join(5)
+
+    assert waited >= 0.3
@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+
+from database import AsyncDatabase, Database
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(db_path=str(tmp_path / 'app.db'), read_pool_size=1)
+    database.init_tables()
+    yield database
+    database.close()
+
+
+def add_concurrently(async_db, *messages):
+    async def run():
+        return await asyncio.gather(
+            *(async_db.add_message(*message) for message in messages),
+            return_exceptions=True
+        )
+    return asyncio.run(run())
+
+
+def stored_contents(db):
+    return [row['content'] for row in db.conn.execute('SELECT content FROM Messages ORDER BY id')]
+
+
+def test_malformed_message_is_rejected_before_batch(db):
+    async_db = AsyncDatabase(db, read_workers=1, batch_window_ms=10)
+
+    results = add_concurrently(async_db, ('text', 'a', 'u'), (None, 'x', 'u'), ('text', 'b', 'u'))
+    async_db.close()
+
+    assert isinstance(results[1], ValueError)
+    assert stored_contents(db) == ['a', 'b']
+
+
+def test_failed_batch_is_retried_one_by_one(db, monkeypatch):
+    add_messages = db.add_messages
+
+    def fail_on_bad(messages):
+        if any(content == 'bad' for _, content, _ in messages):
+            raise RuntimeError('bad row')
+        return add_messages(messages)
+
+    monkeypatch.setattr(db, 'add_messages', fail_on_bad)
+    async_db = AsyncDatabase(db, read_workers=1, batch_window_ms=10)
+
+    results = add_concurrently(async_db, ('text', 'a', 'u'), ('text', 'bad', 'u'), ('text', 'b', 'u'))
+    async_db.close()
+
+    assert isinstance(results[1], RuntimeError)
+    assert not isinstance(results[0], Exception) and not isinstance(results[2], Exception)
+    assert stored_contents(db) == ['a', 'b']
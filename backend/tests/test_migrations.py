@@ -0,0 +1,78 @@
+import pytest
+
+from database import Database, MIGRATIONS
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(db_path=str(tmp_path / 'app.db'), read_pool_size=1)
+    database.init_tables()
+    yield database
+    database.close()
+
+
+def schema_versions(db):
+    return [tuple(row) for row in db.conn.execute('SELECT version, description FROM SchemaVersion ORDER BY version')]
+
+
+def test_migrations_apply_in_order(db):
+    assert schema_versions(db) == [(version, description) for version, description, _ in MIGRATIONS]
+    assert db.get_schema_version() == MIGRATIONS[-1][0]
+
+
+def test_migrations_are_idempotent(db):
+    applied = db.conn.execute('SELECT version, applied_at FROM SchemaVersion').fetchall()
+
+    db.migrate_database()
+
+    assert db.conn.execute('SELECT version, applied_at FROM SchemaVersion').fetchall() == applied
+    assert schema_versions(db) == [(version, description) for version, description, _ in MIGRATIONS]
+
+
+def test_migration_steps_rerun_safely(db):
+    # Шаги должны переживать повторный запуск, например после сбоя до записи версии
+    cursor = db.conn.cursor()
+    for _, _, migration in MIGRATIONS:
+        migration(cursor)
+    db.conn.commit()
+
+
+def test_hot_queries_use_indexes(db):
+    assert db.check_query_plans() == []
+
+
+def test_unused_message_indexes_are_dropped(db):
+    indexes = {row['name'] for row in db.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+    assert 'idx_messages_datetime' not in indexes
+    assert 'idx_messages_user_uuid' not in indexes
+
+
+def test_query_plan_check_catches_missing_index(tmp_path, monkeypatch):
+    # Регрессия: миграция пересоздает Users без первичного ключа, JOIN сообщений с автором теряет индекс
+    def rebuild_users_without_key(cursor):
+        cursor.execute('''
+            CREATE TABLE Users_rebuilt (
+                uuid TEXT NOT NULL,
+                username TEXT NOT NULL,
+                is_admin BOOLEAN NOT NULL DEFAULT FALSE,
+                avatar TEXT DEFAULT NULL
+            )
+        ''')
+        cursor.execute('INSERT INTO Users_rebuilt SELECT uuid, username, is_admin, avatar FROM Users')
+        cursor.execute('DROP TABLE Users')
+        cursor.execute('ALTER TABLE Users_rebuilt RENAME TO Users')
+
+    monkeypatch.setattr('database.MIGRATIONS', MIGRATIONS + [(100, 'Users без ключа', rebuild_users_without_key)])
+    database = Database(db_path=str(tmp_path / 'app.db'), read_pool_size=1)
+    database.init_tables()
+
+    problems = database.check_query_plans()
+    database.close()
+
+    assert sorted(problem.split(':')[0] for problem in problems) == sorted([
+        'последние сообщения',
+        'страница сообщений до курсора',
+        'страница сообщений после курсора',
+        'пользователь по uuid',
+    ])
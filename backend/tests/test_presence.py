@@ -0,0 +1,49 @@
+import asyncio
+
+from handlers.codec import JsonCodec
+from handlers.presence import PresenceAggregator
+
+
+def status(room, username='bob'):
+    return {'room': room, 'username': username, 'user_uuid': f'{username}-uuid',
+            'is_mic_muted': False, 'is_deafened': False, 'is_streaming': False}
+
+
+def run_ticks(*ticks):
+    """Выполнить шаги по тикам (тик вызывается вручную) и вернуть комнаты из разосланных пакетов"""
+    batches = []
+
+    async def run():
+        # Длинный тик: пакеты отправляются только явным flush
+        presence = PresenceAggregator(batches.append, tick_ms=60_000)
+        for tick in ticks:
+            tick(presence)
+            presence.flush()
+
+    asyncio.run(run())
+    return [[update['room'] for update in batch['updates']] for batch in batches]
+
+
+def test_join_and_leave_in_one_tick_cancel():
+    def join_and_leave(presence):
+        presence.publish(status('General'))
+        presence.publish(status('!General'))
+
+    assert run_ticks(join_and_leave) == []
+
+
+def test_leave_after_flushed_join_is_sent():
+    assert run_ticks(
+        lambda presence: presence.publish(status('General')),
+        lambda presence: presence.publish(status('!General')),
+    ) == [['General'], ['!General']]
+
+
+def test_leave_is_sent_when_snapshot_saw_the_join():
+    def join_snapshot_leave(presence):
+        presence.publish(status('General'))
+        # Клиент подключился посреди тика: снимок уже содержит вход
+        presence.snapshot_frame({'General': {'bob': status('General')}}, JsonCodec)
+        presence.publish(status('!General'))
+
+    assert run_ticks(join_snapshot_leave) == [['!General']]
@@ -514,7 +514,10 @@ function handleUserStatusUpdate(data) {
     const isStreaming = data.is_streaming;
 
     if (room.startsWith('!')) {
-        delete connectedVoiceUsers[room.slice(1)][username];
+        // Пользователя может не быть в локальном состоянии, если вход не дошел до клиента
+        if (connectedVoiceUsers[room.slice(1)]) {
+            delete connectedVoiceUsers[room.slice(1)][username];
+        }
         console.log(`deleted ${username} from ${room.slice(1)}`)
         updateParticipantsList();
         return
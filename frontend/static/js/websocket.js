@@ -1,10 +1,30 @@
 let ws = null;
 let ws_reconnect = null;
+// Версия статусов пользователей, чтобы после переподключения получать только изменения
+let presenceEpoch = null;
+let presenceVersion = 0;
+// Задержка переподключения: подсказка сервера при остановке или экспоненциальная с разбросом
+let reconnectHintMs = null;
+let reconnectAttempts = 0;
+
+function nextReconnectDelay() {
+    if (reconnectHintMs !== null) {
+        const delay = reconnectHintMs;
+        reconnectHintMs = null;
+        return delay;
+    }
+    // Случайная половина окна, чтобы клиенты не переподключались одновременно
+    const base = Math.min(30000, 3000 * 2 ** reconnectAttempts);
+    return base / 2 + Math.random() * base / 2;
+}
 
 // Подключение к WebSocket серверу
 function connectWebSocket() {
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${window.BACKEND_URL}/ws?user=${currentUserUUID}`;
+    let wsUrl = `${window.BACKEND_URL}/ws?user=${currentUserUUID}`;
+    if (presenceEpoch) {
+        wsUrl += `&presence_epoch=${presenceEpoch}&presence_version=${presenceVersion}`;
+    }
     ws_reconnect = null;
     
     ws = new WebSocket(wsUrl);
@@ -12,6 +32,7 @@ function connectWebSocket() {
     
     ws.onopen = () => {
         console.log('✓ Подключено к серверу сигнализации');
+        reconnectAttempts = 0;
         if (ws_reconnect) {
             clearTimeout(ws_reconnect);
             ws_reconnect = null;
@@ -21,13 +42,15 @@ function connectWebSocket() {
     ws.onclose = (event) => {
         console.log(`✗ Отключено от сервера: ${event.code} ${event.reason || 'Без причины'}`);
         
-        // Попытка переподключения через 3 секунды
+        const delay = nextReconnectDelay();
+        reconnectAttempts++;
+        console.log(`Переподключение через ${Math.round(delay / 1000)} с`);
         ws_reconnect = setTimeout(() => {
             if (!ws || ws.readyState === WebSocket.CLOSED) {
                 console.log('Попытка переподключения...');
                 connectWebSocket();
             }
-        }, 3000);
+        }, delay);
     };
     
     ws.onerror = (error) => {
@@ -76,12 +99,35 @@ async function handleServerMessage(data) {
 
         case 'user_status_total':
             connectedVoiceUsers = data.data;
+            presenceEpoch = data.epoch;
+            presenceVersion = data.version;
             updateParticipantsList();
             break;
 
         case 'user_status_update':
             handleUserStatusUpdate(data);
             break;
+
+        case 'user_status_batch':
+            // Пакет изменений статусов за один тик сервера
+            if (data.epoch !== presenceEpoch || data.version > presenceVersion + 1) {
+                // Пропущен пакет или сервер перезапущен - запрашиваем недостающее
+                ws.send(JSON.stringify({type: 'presence_sync', epoch: presenceEpoch, since: presenceVersion}));
+                break;
+            }
+            if (data.version <= presenceVersion) {
+                break;
+            }
+            // Версия сдвигается после применения: ошибка в одном изменении не теряет остальные
+            data.updates.forEach(update => {
+                try {
+                    handleUserStatusUpdate(update);
+                } catch (error) {
+                    console.error('Ошибка применения статуса:', error, update);
+                }
+            });
+            presenceVersion = data.version;
+            break;
             
         case 'screen_share_request':
             createScreenShareConnection(data.user_uuid);
@@ -102,8 +148,13 @@ async function handleServerMessage(data) {
             window.chatManager.handleChatMessage(data);
             break;
             
+        case 'reconnect':
+            // Сервер останавливается и подсказывает, когда переподключиться
+            reconnectHintMs = data.delay_ms;
+            break;
+
         case 'ping':
-            sendWsMessage({type: 'pong'})
+            sendWsMessage({type: 'pong', id: data.id})
             break;
             
         case 'error':